@@ -0,0 +1,319 @@
+"""Micro-benchmarks of the hot paths of the web app.
+
+Run the benchmarks and store the results in a JSON file:
+
+    $ python bench.py run -o results.json
+
+Compare the results with a baseline, and exit with status 1 if any
+benchmark is slower by more than the tolerance, or is missing:
+
+    $ python bench.py compare baseline.json results.json -t 0.20
+
+No CouchDB server is needed; the Flask app is set up here without
+the database, and the documents are made up.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os.path
+import platform
+import statistics
+import sys
+import timeit
+
+import flask
+
+import webapp.about
+import webapp.config
+import webapp.hashing
+import webapp.jsonprovider
+import webapp.site
+import webapp.user
+import webapp.api.about
+import webapp.api.export
+import webapp.api.root
+import webapp.api.schema
+import webapp.api.user
+
+from webapp import constants
+from webapp import utils
+from webapp.saver import BaseSaver
+
+# Number of rows for the benchmarks of rendering lists.
+DEFAULT_SIZES = [10, 1000, 100000]
+
+# Min total time (seconds) of the loops in one repeat.
+MIN_TIME = 0.2
+
+
+def get_app():
+    """Return the Flask app set up for rendering templates and URLs,
+    as in 'webapp.main', but without any database connection.
+    """
+    app = flask.Flask("webapp",
+                      root_path=os.path.dirname(webapp.user.__file__),
+                      static_folder=None)
+    app.json = webapp.jsonprovider.JsonProvider(app)
+    app.config.from_mapping(webapp.config.DEFAULT_SETTINGS)
+    app.config["SECRET_KEY"] = "benchmark"
+    app.url_map.converters["identifier"] = utils.IdentifierConverter
+    app.url_map.converters["iuid"] = utils.IuidConverter
+    app.add_template_filter(utils.thousands)
+    app.add_template_filter(utils.tojson2)
+    app.context_processor(lambda: dict(constants=constants,
+                                       csrf_token=utils.csrf_token))
+    # Endpoints defined in 'webapp.main'; only used for building URLs.
+    for rule, endpoint in [("/", "home"),
+                           ("/static/<path:filename>", "static"),
+                           ("/debug", "debug")]:
+        app.add_url_rule(rule, endpoint)
+    app.register_blueprint(webapp.about.blueprint, url_prefix="/about")
+    app.register_blueprint(webapp.user.blueprint, url_prefix="/user")
+    app.register_blueprint(webapp.site.blueprint, url_prefix="/site")
+    app.register_blueprint(webapp.api.root.blueprint, url_prefix="/api")
+    app.register_blueprint(webapp.api.about.blueprint, url_prefix="/api/about")
+    app.register_blueprint(webapp.api.export.blueprint,
+                           url_prefix="/api/export")
+    app.register_blueprint(webapp.api.schema.blueprint,
+                           url_prefix="/api/schema")
+    app.register_blueprint(webapp.api.user.blueprint, url_prefix="/api/user")
+    return app
+
+def get_user(number=0):
+    "Return a made-up user document."
+    return {"_id": utils.get_iuid(),
+            "_rev": "1-0123456789abcdef",
+            "doctype": constants.DOCTYPE_USER,
+            "username": f"user{number}",
+            "email": f"user{number}@example.com",
+            "role": constants.USER,
+            "status": constants.ENABLED,
+            "password": "scrypt:32768:8:1$salt$hash",
+            "apikey": utils.get_iuid(),
+            "created": utils.get_time(),
+            "modified": utils.get_time()}
+
+def get_log(number=0):
+    "Return a made-up log entry."
+    return {"_id": utils.get_iuid(),
+            "doctype": constants.DOCTYPE_LOG,
+            "docid": utils.get_iuid(),
+            "diff": {"updated": {"status": {"new_value": constants.ENABLED,
+                                            "old_value": constants.PENDING}},
+                     "added": {"apikey": "<hidden>"}},
+            "username": "admin",
+            "remote_addr": "127.0.0.1",
+            "user_agent": f"Mozilla/5.0 (benchmark {number})",
+            "timestamp": utils.get_time()}
+
+def get_deep(depth, width, leaf):
+    "Return a nested dictionary with the given depth and width."
+    if depth == 0:
+        return leaf
+    return dict([(f"key{i}", get_deep(depth - 1, width, leaf))
+                 for i in range(width)])
+
+def get_benchmarks(app, sizes):
+    """Return the list of benchmarks: (name, setup), where 'setup' is
+    called within the app context and returns the function to time.
+    A benchmark that needs a request enters its request context into
+    the given exit stack, which is closed after the timing.
+    """
+    result = []
+
+    def saver_diff(old, new):
+        def setup(stack):
+            saver = BaseSaver(old)
+            def func():
+                saver.stack = []
+                saver.diff(old, new)
+            return func
+        return setup
+    old = get_user()
+    new = dict(old, email="changed@example.com", status=constants.DISABLED,
+               apikey=utils.get_iuid())
+    result.append(("saver_diff_shallow", saver_diff(old, new)))
+    old = get_deep(5, 4, "value")
+    new = get_deep(5, 4, "value")
+    new["key0"]["key1"]["key2"]["key3"]["key0"] = "changed"
+    result.append(("saver_diff_deep", saver_diff(old, new)))
+
+    result.append(("get_time", lambda stack: utils.get_time))
+
+    def in_request(func, path="/api/user/user0", headers=None):
+        "Call the function in a request context, pushed once."
+        def setup(stack):
+            stack.enter_context(app.test_request_context(path,
+                                                         headers=headers))
+            return func
+        return setup
+    user = get_user()
+    result.append(("get_json",
+                   in_request(lambda: utils.get_json(**user))))
+    result.append(("jsonify",
+                   in_request(lambda: utils.jsonify(
+                       utils.get_json(**user),
+                       schema_url="http://localhost/api/schema/user"))))
+    def accept_json():
+        "The parsed header is cached in the request; parse it each time."
+        flask.request.__dict__.pop("accept_mimetypes", None)
+        utils.accept_json()
+    result.append(("accept_json",
+                   in_request(accept_json,
+                              headers={"Accept": constants.JSON_MIMETYPE})))
+    result.append(("accept_json_browser",
+                   in_request(accept_json,
+                              headers={"Accept": "text/html,application/"
+                                       "xhtml+xml,application/xml;q=0.9,"
+                                       "*/*;q=0.8"})))
+
+    def converter(cls, value):
+        def setup(stack):
+            converter = cls(app.url_map)
+            return lambda: converter.to_python(value)
+        return setup
+    result.append(("identifier_converter",
+                   converter(utils.IdentifierConverter, "Some_user-name")))
+    result.append(("iuid_converter",
+                   converter(utils.IuidConverter, utils.get_iuid())))
+
+    admin = dict(get_user(), username="admin", role=constants.ADMIN)
+    def render(path, template, **context):
+        "Render the template in a request context, as the admin user."
+        def setup(stack):
+            stack.enter_context(app.test_request_context(path))
+            flask.g.current_user = admin
+            flask.g.am_admin = True
+            return lambda: flask.render_template(template, **context)
+        return setup
+    result.append(("render_user_all", render("/user/all", "user/all.html")))
+
+    def all_data(users):
+        "Produce the JSON for a page of users, as 'webapp.user.all_data' does."
+        def setup(stack):
+            stack.enter_context(app.test_request_context("/user/all/data"))
+            return lambda: webapp.user.get_all_data_response(1, len(users),
+                                                             len(users), users)
+        return setup
+
+    for size in sizes:
+        users = [get_user(i) for i in range(size)]
+        result.append((f"user_all_data_{size}", all_data(users)))
+        logs = [get_log(i) for i in range(size)]
+        result.append((f"render_logs_{size}",
+                       render("/user/display/user0/logs", "logs.html",
+                              title="User user0",
+                              cancel_url="/user/display/user0",
+                              api_logs_url="/api/user/user0/logs",
+                              logs=logs,
+                              next_url="/user/display/user0/logs?cursor=x")))
+
+    def password_hash(stack):
+        password = "benchmark password"
+        pwhash = webapp.hashing.generate_password_hash(password)
+        return lambda: webapp.hashing.check_password_hash(pwhash, password)
+    result.append(("password_hash_check", password_hash))
+    return result
+
+def measure(func, repeat):
+    """Time the function. The number of loops is chosen so that
+    one repeat takes at least MIN_TIME. Return the time per call (seconds)
+    of the fastest and the median repeat.
+    """
+    timer = timeit.Timer(func)
+    loops = 1
+    while True:
+        elapsed = timer.timeit(loops)
+        if elapsed >= MIN_TIME: break
+        loops *= 10 if elapsed < MIN_TIME / 10 else 2
+    times = [elapsed] + timer.repeat(repeat=repeat - 1, number=loops)
+    times = [t / loops for t in times]
+    return dict(min=min(times), median=statistics.median(times),
+                loops=loops, repeat=repeat)
+
+def run(pargs):
+    "Run the benchmarks, output the results, and save them if requested."
+    app = get_app()
+    results = {}
+    with app.app_context():
+        for name, setup in get_benchmarks(app, pargs.sizes):
+            if pargs.filter and pargs.filter not in name: continue
+            with contextlib.ExitStack() as stack:
+                results[name] = measure(setup(stack), pargs.repeat)
+            print(f"{name:30s} {format_time(results[name]['min']):>12s}")
+    data = dict(timestamp=datetime.datetime.utcnow().isoformat() + "Z",
+                version=constants.VERSION,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                results=results)
+    if pargs.output:
+        with open(pargs.output, "w") as outfile:
+            json.dump(data, outfile, indent=2)
+    return 0
+
+def compare(pargs):
+    """Compare the results with the baseline, using the fastest repeats.
+    Return 1 if any benchmark is slower than the baseline by more than
+    the tolerance, or is missing in the results, else 0.
+    """
+    with open(pargs.baseline) as infile:
+        baseline = json.load(infile)["results"]
+    with open(pargs.results) as infile:
+        results = json.load(infile)["results"]
+    status = 0
+    for name in sorted(set(baseline).union(results)):
+        if name not in results:
+            print(f"{name:30s} MISSING in results")
+            status = 1
+            continue
+        if name not in baseline:
+            print(f"{name:30s} new; {format_time(results[name]['min'])}")
+            continue
+        ratio = results[name]["min"] / baseline[name]["min"]
+        if ratio > 1.0 + pargs.tolerance:
+            verdict = "REGRESSION"
+            status = 1
+        elif ratio < 1.0 - pargs.tolerance:
+            verdict = "faster"
+        else:
+            verdict = "ok"
+        print(f"{name:30s} {format_time(baseline[name]['min']):>12s}"
+              f" {format_time(results[name]['min']):>12s}"
+              f" {ratio:6.2f} {verdict}")
+    return status
+
+def format_time(seconds):
+    "Return the time in suitable units."
+    for unit, factor in [("s", 1.0), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= factor:
+            return f"{seconds / factor:.3f} {unit}"
+    return f"{seconds / 1e-9:.1f} ns"
+
+def get_parser():
+    "Get the parser for the command line tool."
+    p = argparse.ArgumentParser(prog='bench.py',
+                                description='webapp micro-benchmarks')
+    commands = p.add_subparsers(dest='command', required=True)
+    x = commands.add_parser('run', help='Run the benchmarks.')
+    x.add_argument('-o', '--output', metavar='FILE',
+                   help='Save the results to the JSON file.')
+    x.add_argument('-f', '--filter', metavar='TEXT',
+                   help='Run only the benchmarks with the text in the name.')
+    x.add_argument('-r', '--repeat', type=int, default=5,
+                   help='Number of repeats of the timing loop.')
+    x.add_argument('-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                   help='Number of rows in the rendered lists.')
+    x.set_defaults(func=run)
+    x = commands.add_parser('compare', help='Compare results with baseline.')
+    x.add_argument('baseline', help='JSON file of baseline results.')
+    x.add_argument('results', help='JSON file of results.')
+    x.add_argument('-t', '--tolerance', type=float, default=0.2,
+                   help='Allowed slowdown as a fraction; default 0.2.')
+    x.set_defaults(func=compare)
+    return p
+
+if __name__ == '__main__':
+    pargs = get_parser().parse_args()
+    sys.exit(pargs.func(pargs))
@@ -2,6 +2,8 @@
 
 import http.client
 
+import requests
+
 import base
 
 
@@ -14,6 +16,36 @@ class Root(base.Base):
         response = self.GET(url)
         self.check_schema(response)
 
+    def test_root_schema_cached(self):
+        "Get the API root JSON schema by its versioned URL."
+        url = f"{base.SETTINGS['ROOT_URL']}"
+        response = self.GET(url)
+        url = response.links['schema']['url']
+        self.assertIn("?v=", url)
+        response = self.GET(url)
+        self.assertEqual(response.status_code, http.client.OK)
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        response = self.session.get(
+            url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, http.client.NOT_MODIFIED)
+
+    def test_root_server_timing_anonymous(self):
+        "No Server-Timing header in responses to anonymous users."
+        url = f"{base.SETTINGS['ROOT_URL']}"
+        response = requests.get(url)
+        self.assertEqual(response.status_code, http.client.OK)
+        self.assertNotIn("Server-Timing", response.headers)
+
+    def test_metrics(self):
+        "Get the metrics in Prometheus text format; admin user."
+        self.GET(base.SETTINGS['ROOT_URL'])
+        url = base.SETTINGS['ROOT_URL'].rsplit("/api", 1)[0] + "/metrics"
+        response = self.GET(url)
+        self.assertEqual(response.status_code, http.client.OK)
+        self.assertIn("text/plain", response.headers["Content-Type"])
+        self.assertIn("webapp_request_duration_seconds_count", response.text)
+        self.assertIn("webapp_requests_in_flight", response.text)
+
 
 if __name__ == '__main__':
     base.run()
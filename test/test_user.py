@@ -1,6 +1,7 @@
 "Test the user API endpoints."
 
 import http.client
+import json
 
 import base
 
@@ -14,12 +15,57 @@ class User(base.Base):
         response = self.GET(url)
         user = self.check_schema(response)
 
+    def test_user_not_modified(self):
+        "Get user JSON again, conditional on its ETag."
+        url = f"{base.SETTINGS['ROOT_URL']}/user/{base.SETTINGS['USERNAME']}"
+        response = self.GET(url)
+        self.check_schema(response)
+        etag = response.headers["ETag"]
+        response = self.session.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, http.client.NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], etag)
+
+    def test_user_logs_pages(self):
+        "Get user logs JSON, one entry per page."
+        url = f"{base.SETTINGS['ROOT_URL']}/user/{base.SETTINGS['USERNAME']}/logs?limit=1"
+        timestamps = []
+        while url:
+            response = self.GET(url)
+            self.assertEqual(response.status_code, http.client.OK)
+            data = response.json()
+            self.assertLessEqual(len(data["logs"]), 1)
+            timestamps.extend([l["timestamp"] for l in data["logs"]])
+            url = data.get("next", {}).get("href")
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
     def test_users_data(self):
         "Get all users JSON."
         url = f"{base.SETTINGS['ROOT_URL']}/user"
         response = self.GET(url)
         user = self.check_schema(response)
 
+    def test_users_export(self):
+        "Get all users as newline-delimited JSON."
+        url = f"{base.SETTINGS['ROOT_URL']}/export/users"
+        response = self.GET(url)
+        self.assertEqual(response.status_code, http.client.OK)
+        self.assertEqual(response.headers["Content-Type"],
+                         "application/x-ndjson")
+        usernames = [json.loads(line)["username"]
+                     for line in response.text.splitlines()]
+        self.assertIn(base.SETTINGS['USERNAME'], usernames)
+
+    def test_logs_export(self):
+        "Get all log entries as newline-delimited JSON; read the stream."
+        url = f"{base.SETTINGS['ROOT_URL']}/export/logs"
+        response = self.session.get(url, stream=True)
+        self.assertEqual(response.status_code, http.client.OK)
+        logs = [json.loads(line) for line in response.iter_lines() if line]
+        self.assertGreater(len(logs), 0)
+        for log in logs:
+            self.assertIn("iuid", log)
+            self.assertIn("docid", log)
+
 
 if __name__ == '__main__':
     base.run()
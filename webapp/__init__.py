@@ -20,6 +20,8 @@ class Constants:
     # CouchDB document types
     DOCTYPE_USER = "user"
     DOCTYPE_LOG  = "log"
+    DOCTYPE_THROTTLE = "throttle"
+    DOCTYPE_MESSAGE = "message"
 
     # User roles
     ADMIN = "admin"
@@ -35,6 +37,8 @@ class Constants:
     # Content types
     HTML_MIMETYPE = "text/html"
     JSON_MIMETYPE = "application/json"
+    NDJSON_MIMETYPE = "application/x-ndjson"
+    PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4"
 
     # Misc
     JSON_SCHEMA_URL = "http://json-schema.org/draft-07/schema#"
@@ -8,6 +8,7 @@ import jsonschema
 
 import webapp
 from webapp import constants
+from webapp import tracing
 from webapp import utils
 
 
@@ -45,3 +46,15 @@ def settings():
             config[key] = "<hidden>"
     return flask.render_template("about/settings.html",
                                  items=sorted(config.items()))
+
+@blueprint.route("/couchdb")
+@utils.admin_required
+def couchdb():
+    "Show the slowest of the recent CouchDB calls in this process."
+    try:
+        number = int(flask.request.args.get("number") or 50)
+    except ValueError:
+        number = 50
+    return flask.render_template("about/couchdb.html",
+                                 calls=tracing.get_slowest(number),
+                                 number=number)
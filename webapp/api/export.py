@@ -0,0 +1,47 @@
+"Export API endpoints; newline-delimited JSON, for admin."
+
+import http.client
+
+import flask
+
+from webapp import utils
+
+
+blueprint = flask.Blueprint("api_export", __name__)
+
+@blueprint.route("/users")
+def users():
+    "Stream all users as newline-delimited JSON."
+    if not flask.g.am_admin:
+        flask.abort(http.client.FORBIDDEN)
+    rows = utils.iter_view("users", "username",
+                           flask.current_app.config["EXPORT_PAGE_SIZE"],
+                           read="users_list",
+                           include_docs=True)
+    return utils.ndjson_response(get_user_export(r.doc) for r in rows)
+
+@blueprint.route("/logs")
+def logs():
+    "Stream all log entries as newline-delimited JSON."
+    if not flask.g.am_admin:
+        flask.abort(http.client.FORBIDDEN)
+    rows = utils.iter_view("logs", "doc",
+                           flask.current_app.config["EXPORT_PAGE_SIZE"],
+                           read="logs",
+                           include_docs=True)
+    return utils.ndjson_response(get_log_export(r.doc) for r in rows)
+
+def get_user_export(user):
+    "Return the JSON data for a user in an export."
+    result = {"iuid": user["_id"]}
+    for key in ["username", "email", "role", "status", "created", "modified"]:
+        result[key] = user.get(key)
+    return result
+
+def get_log_export(log):
+    "Return the JSON data for a log entry in an export."
+    result = {"iuid": log.pop("_id")}
+    log.pop("_rev", None)
+    log.pop("doctype", None)
+    result.update(log)
+    return result
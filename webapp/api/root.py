@@ -39,6 +39,12 @@ def root():
         items["users"] = {
             "href": flask.url_for("api_user.all", _external=True)
         }
+        items["export"] = {
+            "users": {"href": flask.url_for("api_export.users",
+                                            _external=True)},
+            "logs": {"href": flask.url_for("api_export.logs",
+                                           _external=True)}
+        }
     return utils.jsonify(utils.get_json(**items),
                          schema_url=flask.url_for("api_schema.root",
                                                   _external=True))
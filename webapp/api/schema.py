@@ -1,5 +1,9 @@
 "JSON schemas for the API."
 
+import hashlib
+import http.client
+import json
+
 import flask
 
 from webapp import constants
@@ -65,6 +69,14 @@ LOGS = {
                 ],
                 "additionalProperties": False
             }
+        },
+        "next": {
+            "type": "object",
+            "properties": {
+                "href": _URI
+            },
+            "required": ["href"],
+            "additionalProperties": False
         }
     }
 }
@@ -159,24 +171,64 @@ USERS = {
     "additionalProperties": False
 }
 
+def get_serialized(items):
+    """Return the schemas serialized, with their content hashes,
+    by endpoint name.
+    """
+    result = {}
+    for name, doc in items:
+        data = json.dumps(doc).encode()
+        result[name] = (data, hashlib.sha256(data).hexdigest()[:16])
+    return result
+
+# The schemas serialized once; by endpoint name.
+SCHEMAS = get_serialized([("root", ROOT),
+                          ("logs", LOGS),
+                          ("about_software", ABOUT_SOFTWARE),
+                          ("user", USER),
+                          ("users", USERS)])
+
 blueprint = flask.Blueprint("api_schema", __name__)
 
+@blueprint.url_defaults
+def add_version(endpoint, values):
+    "Version the schema URLs by content hash, so they can be cached long."
+    values.setdefault("v", SCHEMAS[endpoint.split(".")[-1]][1])
+
 @blueprint.route("/root")
 def root():
-    return flask.jsonify(ROOT)
+    return get_response("root")
 
 @blueprint.route("/logs")
 def logs():
-    return flask.jsonify(LOGS)
+    return get_response("logs")
 
 @blueprint.route("/about/software")
 def about_software():
-    return flask.jsonify(ABOUT_SOFTWARE)
+    return get_response("about_software")
 
 @blueprint.route("/user")
 def user():
-    return flask.jsonify(USER)
+    return get_response("user")
 
 @blueprint.route("/users")
 def users():
-    return flask.jsonify(USERS)
+    return get_response("users")
+
+def get_response(name):
+    """Return the response for the precomputed schema.
+    It may be cached indefinitely if requested by the versioned URL.
+    """
+    data, etag = SCHEMAS[name]
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=http.client.NOT_MODIFIED)
+    else:
+        response = flask.Response(data, mimetype=constants.JSON_MIMETYPE)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if flask.request.args.get("v") == etag:
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
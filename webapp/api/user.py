@@ -5,6 +5,7 @@ import http.client
 import flask
 
 import webapp.user
+from webapp import constants
 from webapp import utils
 
 blueprint = flask.Blueprint("api_user", __name__)
@@ -13,7 +14,8 @@ blueprint = flask.Blueprint("api_user", __name__)
 def all():
     if not flask.g.am_admin:
         flask.abort(http.client.FORBIDDEN)
-    users = [get_user_basic(u) for u in webapp.user.get_users()]
+    users = [get_user_basic(u)
+             for u in webapp.user.get_users(read="users_list")]
     return utils.jsonify(utils.get_json(users=users),
                          schema_url=flask.url_for("api_schema.users",
                                                   _external=True))
@@ -25,14 +27,18 @@ def display(username):
         flask.abort(http.client.NOT_FOUND)
     if not webapp.user.am_admin_or_self(user):
         flask.abort(http.client.FORBIDDEN)
+    etag = utils.get_etag(constants.VERSION, user["_rev"])
+    response = utils.not_modified(etag)
+    if response: return response
     user.pop("password", None)
     user.pop("apikey", None)
     user["logs"] = {"href": flask.url_for(".logs",
                                           username=user["username"],
                                           _external=True)}
-    return utils.jsonify(utils.get_json(**user),
-                         schema_url=flask.url_for("api_schema.user",
-                                                  _external=True))
+    response = utils.jsonify(utils.get_json(**user),
+                             schema_url=flask.url_for("api_schema.user",
+                                                      _external=True))
+    return utils.set_etag(response, etag)
 
 @blueprint.route("/<identifier:username>/logs")
 def logs(username):
@@ -41,10 +47,30 @@ def logs(username):
         flask.abort(http.client.NOT_FOUND)
     if not webapp.user.am_admin_or_self(user):
         flask.abort(http.client.FORBIDDEN)
-    return utils.jsonify(utils.get_json(user=get_user_basic(user),
-                                        logs=utils.get_logs(user["_id"])),
-                         schema_url=flask.url_for("api_schema.logs",
-                                                  _external=True))
+    try:
+        limit = utils.get_page_limit()
+        etag = utils.get_etag(constants.VERSION,
+                              utils.get_latest_log_key(user["_id"]),
+                              limit,
+                              flask.request.args.get("cursor"))
+        response = utils.not_modified(etag)
+        if response: return response
+        logs, cursor = utils.get_logs_page(user["_id"], limit,
+                                           flask.request.args.get("cursor"))
+    except ValueError as error:
+        raise utils.JsonException(error)
+    result = utils.get_json(user=get_user_basic(user), logs=logs)
+    if cursor:
+        result["next"] = {"href": flask.url_for(
+            ".logs",
+            username=user["username"],
+            limit=flask.request.args.get("limit"),
+            cursor=cursor,
+            _external=True)}
+    response = utils.jsonify(result,
+                             schema_url=flask.url_for("api_schema.logs",
+                                                      _external=True))
+    return utils.set_etag(response, etag)
 
 def get_user_basic(user):
     "Return the basic JSON data for a user."
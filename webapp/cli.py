@@ -6,7 +6,10 @@ import sys
 
 import flask
 
+import webapp.hashing
 import webapp.main
+import webapp.outbox
+import webapp.saver
 import webapp.user
 
 from webapp import constants
@@ -25,6 +28,14 @@ def get_parser():
                     help='Create an admin user.')
     x0.add_argument('-U', '--create_user', action='store_true',
                     help='Create a user.')
+    x0.add_argument('-D', '--deploy_designs', action='store_true',
+                    help='Deploy design documents and indexes; build views.')
+    x0.add_argument('-P', '--purge_outbox', type=int, metavar='DAYS',
+                    help='Delete the email messages sent or failed more'
+                    ' than the given number of days ago.')
+    x0.add_argument('-C', '--calibrate_hash', type=int, metavar='MS',
+                    help='Output the password hash method setting that takes'
+                    ' about the given number of milliseconds on this machine.')
     return p
 
 def execute(pargs):
@@ -46,6 +57,14 @@ def execute(pargs):
             saver.set_password(getpass.getpass('password > '))
             saver.set_role(constants.USER)
             saver.set_status(constants.ENABLED)
+    if pargs.deploy_designs:
+        utils.deploy_designs(flask.g.db, log=print)
+    if pargs.purge_outbox is not None:
+        count = webapp.outbox.purge(flask.g.db, pargs.purge_outbox)
+        print(f"Deleted {count} messages.")
+    if pargs.calibrate_hash:
+        method = webapp.hashing.calibrate(pargs.calibrate_hash / 1000.0)
+        print(f'"PASSWORD_HASH_METHOD": "{method}"')
 
 def main():
     "Entry point for command line interface."
@@ -55,7 +74,10 @@ def main():
         parser.print_usage()
     with webapp.main.app.app_context():
         flask.g.db = utils.get_db()
-        execute(pargs)
+        try:
+            execute(pargs)
+        finally:
+            webapp.saver.flush_log_writer()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,136 @@
+"Response compression; gzip, and brotli if the module is installed."
+
+import mimetypes
+import os.path
+import zlib
+
+import flask
+import werkzeug.security
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Precompressed file extensions, by content encoding; in order of preference.
+EXTENSIONS = [("br", ".br"), ("gzip", ".gz")]
+
+def init(app):
+    "Initialize; compress responses after request."
+    app.after_request(compress_response)
+
+def get_encoding(encodings):
+    "Return the best of the given content encodings accepted by the client."
+    accept = flask.request.accept_encodings
+    best = None
+    for encoding in encodings:
+        if accept[encoding] and (best is None or accept[encoding] > accept[best]):
+            best = encoding
+    return best
+
+def get_response_encoding():
+    "Return the content encoding to use for the response, if any."
+    if brotli and flask.current_app.config["COMPRESS_BROTLI"]:
+        return get_encoding(["br", "gzip"])
+    else:
+        return get_encoding(["gzip"])
+
+def weaken_etag(response):
+    "The representation depends on the content encoding; weaken the ETag."
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+def compress_response(response):
+    """Compress the response if the client accepts it, and the content type
+    is in the allowlist, and it is large enough, or is streamed.
+    Files are not compressed here; see 'send_from_directory'.
+    The ETag is weakened if the client accepts compression, whether the
+    response is compressed or not, so that a 304 Not Modified response
+    has the same ETag as the full response.
+    A response containing a CSRF token is not compressed, since that
+    would allow guessing it from the compressed size (BREACH).
+    """
+    config = flask.current_app.config
+    if response.status_code == 304:
+        if not response.direct_passthrough and get_response_encoding():
+            weaken_etag(response)
+        return response
+    if response.status_code < 200 or response.status_code == 204:
+        return response
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype not in config["COMPRESS_MIMETYPES"]:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = get_response_encoding()
+    if encoding is None:
+        return response
+    weaken_etag(response)
+    if flask.g.get("csrf_token_output"):
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding,
+                                            config["COMPRESS_LEVEL"])
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data))
+        else:
+            compressor = gzip_compressor(config["COMPRESS_LEVEL"])
+            response.set_data(compressor.compress(data) +
+                              compressor.flush(zlib.Z_FINISH))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+def gzip_compressor(level):
+    "Return a gzip compressor object."
+    return zlib.compressobj(level, zlib.DEFLATED, 31) # gzip header, trailer.
+
+def compress_stream(chunks, encoding, level):
+    """Return a generator compressing the chunks. Flush after each chunk,
+    so that the client gets data as it is produced.
+    The generator runs outside of the request context.
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = gzip_compressor(level)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush(zlib.Z_FINISH)
+
+def send_from_directory(dirpath, filename):
+    """Send the file from the directory. Send a precompressed variant,
+    a sibling file with extension '.br' or '.gz', if it exists and the
+    client accepts that content encoding.
+    """
+    encodings = []
+    for encoding, extension in EXTENSIONS:
+        filepath = werkzeug.security.safe_join(dirpath, filename + extension)
+        if filepath and os.path.isfile(filepath):
+            encodings.append(encoding)
+    encoding = encodings and get_encoding(encodings)
+    if not encoding:
+        response = flask.send_from_directory(dirpath, filename)
+        if encodings:
+            response.vary.add("Accept-Encoding")
+        return response
+    extension = dict(EXTENSIONS)[encoding]
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = flask.send_from_directory(dirpath, filename + extension,
+                                         mimetype=mimetype,
+                                         download_name=os.path.basename(filename))
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
@@ -19,20 +19,69 @@ DEFAULT_SETTINGS = dict(
     LOG_NAME = "webapp",
     LOG_FILEPATH = None,
     LOG_ROTATING = 0,           # Number of backup rotated log files, if any.
+    LOG_ROTATE_WHEN = "midnight", # Time of rotation; see logging.handlers.
+    LOG_ROTATE_BYTES = 0,       # Rotate by size instead, if not zero.
+    LOG_JSON = True,            # JSON lines records; else LOG_FORMAT.
     LOG_FORMAT = "%(levelname)-10s %(asctime)s %(message)s",
+    LOG_QUEUE_SIZE = 10000,     # Records written by a separate thread; 0 = not.
+    LOG_ACCESS_SAMPLE = 1.0,    # Fraction of requests logged; not server errors.
     HOST_LOGO = None,           # Filename, must be in 'SITE_STATIC_DIRPATH'
     HOST_NAME = None,
     HOST_URL = None,
     SECRET_KEY = None,          # Must be set in 'settings.json'
     SALT_LENGTH = 12,
+    # Method with cost parameters, as in the stored hash; see werkzeug.security
+    # The command-line interface can calibrate it for the machine.
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1",
+    PASSWORD_HASH_WORKERS = 2,  # Number of threads for password hashing.
+    PASSWORD_HASH_QUEUE = 8,    # Max number of hash operations waiting.
+    PASSWORD_HASH_TIMEOUT = 5.0, # seconds; max wait for hashing.
+    LOGIN_THROTTLE_WINDOW = 300, # seconds; sliding window for failed logins.
+    LOGIN_THROTTLE_USERNAME = 5, # Max failed logins per username and IP address.
+    LOGIN_THROTTLE_IP = 20,     # Max failed logins per IP address; 0 = no limit.
+    LOGIN_THROTTLE_SIZE = 10000, # Max number of usernames and IPs in memory.
+    LOGIN_THROTTLE_SHARED = False, # Share between processes via CouchDB.
+    PROXY_COUNT = 0,            # Number of reverse proxies in front; the client
+                                # IP address is then from X-Forwarded-For.
     COUCHDB_URL = "http://127.0.0.1:5984/",
     COUCHDB_USERNAME = None,
     COUCHDB_PASSWORD = None,
     COUCHDB_DBNAME = "webapp",
+    COUCHDB_POOL_SIZE = 10,     # Max number of connections per process.
+    COUCHDB_POOL_TIMEOUT = 10.0, # seconds; wait for a free connection.
+    COUCHDB_POOL_MAX_AGE = 300.0, # seconds; renew connection when older.
+    # Reads that may use stale view indexes, with the view 'update' value
+    # "false" or "lazy". Reads: "users_list", "logs". Others are up to date.
+    COUCHDB_STALE_READS = {},
+    COUCHDB_TRACE_SIZE = 1000,  # Number of recent calls kept; 0 disables.
+    COUCHDB_SLOW_THRESHOLD = 500, # milliseconds; slower calls are logged.
+    COUCHDB_SLOW_LOG_FILEPATH = None, # Slow-query log file; else the app log.
+    SAVER_BULK_DOCS = True,     # Store document and log entry in one request.
+    SAVER_LOG_ASYNC = False,    # Store log entries in a background thread.
+    SAVER_LOG_BATCH_SIZE = 100, # Max number of log entries per request.
+    SAVER_LOG_INTERVAL = 200,   # milliseconds; max wait to fill a batch.
+    SAVER_LOG_QUEUE_SIZE = 10000, # Max number of queued log entries.
+    SAVER_LOG_PUT_TIMEOUT = 1.0, # seconds; wait when queue full, then store.
+    SAVER_LOG_FLUSH_TIMEOUT = 10.0, # seconds; max wait for flush and close.
     JSON_AS_ASCII = False,
     JSON_SORT_KEYS = False,
     JSONIFY_PRETTYPRINT_REGULAR = False,
+    COMPRESS_MIN_SIZE = 500,    # bytes; smaller responses are not compressed.
+    COMPRESS_LEVEL = 6,         # gzip compression level.
+    COMPRESS_BROTLI = True,     # Used only if the 'brotli' module is installed.
+    COMPRESS_MIMETYPES = ["text/html", "text/css", "text/plain",
+                          "text/javascript", "application/javascript",
+                          constants.JSON_MIMETYPE, constants.NDJSON_MIMETYPE],
     MIN_PASSWORD_LENGTH = 6,
+    LOGS_PAGE_LIMIT = 100,      # Default number of log entries per page.
+    PAGE_MAX_LIMIT = 1000,      # Max number of items per page.
+    LOGS_PAGE_MAX_LIMIT = None, # Former name of PAGE_MAX_LIMIT; used if set.
+    USER_SEARCH_LIMIT = 1000,   # Max number of users matched by a search.
+    EXPORT_PAGE_SIZE = 1000,    # Number of documents fetched per request.
+    FIND_BATCH_SIZE = 1000,     # Number of documents per Mango query request.
+    SERVER_TIMING = False,      # Server-Timing header in responses to admins.
+    METRICS_ALLOW = [],         # IP addresses allowed '/metrics'; not proxied.
+                                # Admin users are always allowed.
     PERMANENT_SESSION_LIFETIME = 7 * 24 * 60 * 60, # seconds; 1 week
     MAIL_SERVER = "localhost",
     MAIL_PORT = 25,
@@ -40,8 +89,22 @@ DEFAULT_SETTINGS = dict(
     MAIL_USERNAME = None,
     MAIL_PASSWORD = None,
     MAIL_DEFAULT_SENDER = None,
+    OUTBOX_ASYNC = True,        # Send email in a background thread; else
+                                # in the request, and retry in the thread.
+    OUTBOX_BATCH_SIZE = 20,     # Max number of messages claimed at a time.
+    OUTBOX_POLL_INTERVAL = 30.0, # seconds; check for messages due for retry.
+    OUTBOX_MAX_ATTEMPTS = 5,    # Then the message is marked as 'failed'.
+    OUTBOX_RETRY_DELAY = 60.0,  # seconds; doubled for each failed attempt.
+    OUTBOX_CLAIM_TIMEOUT = 300.0, # seconds; then retry if not sent.
+    OUTBOX_CAPTURE = False,     # Keep messages in memory; for testing.
     USER_ENABLE_IMMEDIATELY = False,
     USER_ENABLE_EMAIL_WHITELIST = [], # List of fnmatch expressions
+    USER_CACHE_TTL = 60.0,      # seconds; then evicted.
+    USER_CACHE_REVALIDATE = 2.0, # seconds; then check revision in CouchDB.
+    USER_CACHE_SIZE = 1000,     # Max number of cached users; 0 disables.
+    USER_APIKEY_FILTER_REFRESH = 0, # seconds; reload of API key set; 0 = off.
+                                # Only for a single worker process, since
+                                # keys set by others are rejected until reload.
 )
 
 def init(app):
@@ -80,7 +143,13 @@ def init(app):
             app.config[key] = convert(os.environ[key])
         except (KeyError, TypeError, ValueError):
             pass
+    # Setting renamed; the former name is used if the new one is not set.
+    if app.config["LOGS_PAGE_MAX_LIMIT"] and \
+       app.config["PAGE_MAX_LIMIT"] == DEFAULT_SETTINGS["PAGE_MAX_LIMIT"]:
+        app.config["PAGE_MAX_LIMIT"] = app.config["LOGS_PAGE_MAX_LIMIT"]
     # Sanity check; should not execute if this fails.
     assert app.config["SECRET_KEY"]
     assert app.config["SALT_LENGTH"] > 6
     assert app.config["MIN_PASSWORD_LENGTH"] > 4
+    assert app.config["COUCHDB_POOL_SIZE"] > 0
+    assert app.config["PASSWORD_HASH_WORKERS"] > 0
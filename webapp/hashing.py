@@ -0,0 +1,127 @@
+"""Password hashing in a bounded pool of worker threads.
+The hash functions release the GIL, so the pool size caps the CPU usage.
+"""
+
+import concurrent.futures
+import threading
+import time
+
+import flask
+import werkzeug.security
+
+from webapp import timing
+from webapp import utils
+
+
+class BusyError(ValueError):
+    "Too many password hash operations waiting."
+
+
+class HashPool(utils.ProcessLocal):
+    """Pool of threads for password hashing. Callers wait for a slot,
+    of which there are as many as threads plus the allowed queue length.
+    """
+
+    def __init__(self, app):
+        self.workers = app.config["PASSWORD_HASH_WORKERS"]
+        self.slots = self.workers + app.config["PASSWORD_HASH_QUEUE"]
+        self.timeout = app.config["PASSWORD_HASH_TIMEOUT"]
+        self.reset()
+
+    def reset(self):
+        "Set up the threads and slots."
+        super().reset()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="HashPool")
+        self.semaphore = threading.BoundedSemaphore(self.slots)
+
+    def call(self, func, *args, **kwargs):
+        """Execute the function in a thread, and return its result.
+        Raise BusyError if no slot became free within the timeout.
+        """
+        start = time.perf_counter()
+        if not self.semaphore.acquire(timeout=self.timeout):
+            raise BusyError("Too many logins in progress; try again shortly.")
+        try:
+            return self.executor.submit(func, *args, **kwargs).result()
+        finally:
+            self.semaphore.release()
+            timing.add("hash", time.perf_counter() - start)
+
+def get_pool(app=None):
+    "Get the hash pool for this worker process, creating it if needed."
+    return utils.get_instance(HashPool, app)
+
+def generate_password_hash(password):
+    "Return the hash of the password, using the configured method."
+    config = flask.current_app.config
+    return get_pool().call(werkzeug.security.generate_password_hash,
+                           password,
+                           method=config["PASSWORD_HASH_METHOD"],
+                           salt_length=config["SALT_LENGTH"])
+
+def check_password_hash(pwhash, password):
+    "Does the password match the hash?"
+    return get_pool().call(werkzeug.security.check_password_hash,
+                           pwhash, password)
+
+def needs_rehash(pwhash):
+    """Was the hash made using another method or cost parameters
+    than those configured?
+    """
+    method = pwhash.split("$", 1)[0]
+    return method != get_full_method(
+        flask.current_app.config["PASSWORD_HASH_METHOD"])
+
+def get_full_method(method):
+    """Return the method with all cost parameters, as stored in the hash;
+    the omitted parameters are set to the werkzeug defaults.
+    """
+    name, *args = method.split(":")
+    if name == "scrypt" and not args:
+        return "scrypt:32768:8:1"
+    if name == "pbkdf2" and len(args) < 2:
+        hashname = args[0] if args else "sha256"
+        iterations = werkzeug.security.DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hashname}:{iterations}"
+    return method
+
+def calibrate(target, method=None):
+    """Return the hash method with the cost parameter that makes hashing
+    take about the target time (in seconds) on this machine.
+    The algorithm is that of the given method, 'pbkdf2' or 'scrypt'.
+    """
+    if method is None:
+        method = flask.current_app.config["PASSWORD_HASH_METHOD"]
+    if method.startswith("scrypt"):
+        parts = method.split(":")
+        r = int(parts[2]) if len(parts) > 2 else 8
+        p = int(parts[3]) if len(parts) > 3 else 1
+        # Cost doubles with n; find the power of 2 closest to the target.
+        n = 2 ** 10
+        while True:
+            elapsed = get_hash_time(f"scrypt:{n}:{r}:{p}")
+            # Memory use is 128 * n * r bytes; limit it.
+            if elapsed * 1.5 > target or n >= 2 ** 17: break
+            n *= 2
+        return f"scrypt:{n}:{r}:{p}"
+    else:
+        parts = method.split(":")
+        hashname = parts[1] if len(parts) > 1 else "sha256"
+        # Cost is linear in the number of iterations.
+        iterations = 10000
+        elapsed = get_hash_time(f"pbkdf2:{hashname}:{iterations}")
+        iterations = int(iterations * target / elapsed)
+        iterations = max(10000, round(iterations, -3))
+        return f"pbkdf2:{hashname}:{iterations}"
+
+def get_hash_time(method, repeat=3):
+    "Return the shortest time (in seconds) of hashing using the method."
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        werkzeug.security.generate_password_hash("calibration", method=method)
+        elapsed = time.perf_counter() - start
+        if result is None or elapsed < result:
+            result = elapsed
+    return result
@@ -0,0 +1,148 @@
+"""JSON encoding and decoding; orjson if the module is installed.
+Used for the Flask app, and for the CouchDB server requests and responses.
+"""
+
+import functools
+import json
+import time
+import urllib.parse
+
+import flask
+import flask.json.provider
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from webapp import constants
+from webapp import metrics
+from webapp import timing
+from webapp import tracing
+
+
+def dumps_bytes(obj, sort_keys=False, ensure_ascii=False, indent=None,
+                default=None):
+    """Return the JSON representation of the object as UTF-8 bytes.
+    Use orjson if installed and possible; it cannot do ASCII-only output,
+    other indents than 2, or integers beyond 64 bits.
+    """
+    if orjson and not ensure_ascii and indent in (None, 2):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except TypeError:
+            pass
+    return json.dumps(obj, sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+                      indent=indent, default=default).encode("utf-8")
+
+def loads(s):
+    "Return the object decoded from the JSON string or bytes."
+    if orjson:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+class JsonProvider(flask.json.provider.DefaultJSONProvider):
+    """JSON provider for the Flask app. Uses the settings JSON_SORT_KEYS,
+    JSON_AS_ASCII and JSONIFY_PRETTYPRINT_REGULAR.
+    """
+
+    def dumps(self, obj, **kwargs):
+        config = self._app.config
+        sort_keys = kwargs.pop("sort_keys", config["JSON_SORT_KEYS"])
+        ensure_ascii = kwargs.pop("ensure_ascii", config["JSON_AS_ASCII"])
+        indent = kwargs.pop("indent", None)
+        default = kwargs.pop("default", self.default)
+        if kwargs:
+            kwargs.update(sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+                          indent=indent, default=default)
+            return json.dumps(obj, **kwargs)
+        return dumps_bytes(obj, sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+                           indent=indent, default=default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return json.loads(s, **kwargs)
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        "Return a response containing the JSON of the given data."
+        obj = self._prepare_response_obj(args, kwargs)
+        if self._app.config["JSONIFY_PRETTYPRINT_REGULAR"] or self._app.debug:
+            indent = 2
+        else:
+            indent = None
+        data = dumps_bytes(obj,
+                           sort_keys=self._app.config["JSON_SORT_KEYS"],
+                           ensure_ascii=self._app.config["JSON_AS_ASCII"],
+                           indent=indent,
+                           default=self.default)
+        return self._app.response_class(data + b"\n", mimetype=self.mimetype)
+
+
+class CouchSession(requests.Session):
+    """HTTP session for the CouchDB server, using the JSON functions above.
+    The duration of each call is added to the timing of the request,
+    and to the metrics. The call is traced, and logged if slow, whatever
+    its outcome.
+    """
+
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        if kwargs.get("json") is not None:
+            kwargs["data"] = dumps_bytes(kwargs.pop("json"))
+            headers = dict(kwargs.get("headers") or {})
+            headers.setdefault("Content-Type", constants.JSON_MIMETYPE)
+            kwargs["headers"] = headers
+        response = None
+        status = None
+        try:
+            response = super().request(method, url, **kwargs)
+            status = response.status_code
+        except Exception as error:
+            status = type(error).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            path = urllib.parse.urlsplit(url).path
+            timing.add("db", elapsed)
+            metrics.observe_couchdb(method, path, elapsed)
+            data = kwargs.get("data")
+            if response is None or kwargs.get("stream"):
+                received = None
+            else:
+                received = len(response.content)
+            entry = tracing.record(method, path, kwargs.get("params"), status,
+                                   len(data) if data else 0, received, elapsed)
+        if response.headers.get("Content-Type", "").startswith(
+                constants.JSON_MIMETYPE):
+            response.json = functools.partial(_response_json, response, entry)
+        return response
+
+def _response_json(response, entry, **kwargs):
+    """Decode the response content; using the standard method if arguments.
+    Complete the trace entry of the call, if traced.
+    """
+    if kwargs:
+        data = requests.Response.json(response, **kwargs)
+    else:
+        data = loads(response.content)
+    if entry is not None:
+        tracing.finish(entry, data)
+    return data
+
+def use_couch_session(server):
+    "Replace the HTTP session of the CouchDB server connection."
+    session = CouchSession()
+    session.headers.update(server._session.headers)
+    session.cookies.update(server._session.cookies)
+    session.auth = server._session.auth
+    session.verify = server._session.verify
+    server._session.close()
+    server._session = session
@@ -1,16 +1,28 @@
 "Web app template; main."
 
+import http.client
+import os.path
+
 import flask
 import jinja2.utils
+import werkzeug.middleware.proxy_fix
 
 import webapp.about
+import webapp.compress
 import webapp.config
+import webapp.jsonprovider
+import webapp.metrics
+import webapp.outbox
+import webapp.throttle
+import webapp.timing
+import webapp.tracing
 import webapp.user
 import webapp.site
 # To be developed.
 # import webapp.entity
 
 import webapp.api.about
+import webapp.api.export
 import webapp.api.root
 import webapp.api.schema
 import webapp.api.user
@@ -18,13 +30,25 @@ import webapp.api.user
 from webapp import constants
 from webapp import utils
 
-app = flask.Flask(__name__)
+# The static files are served by the route defined below.
+app = flask.Flask(__name__, static_folder=None)
+app.json = webapp.jsonprovider.JsonProvider(app)
 
 # Get the configuration and initialize modules (database).
 webapp.config.init(app)
+if app.config["PROXY_COUNT"]:
+    app.wsgi_app = werkzeug.middleware.proxy_fix.ProxyFix(
+        app.wsgi_app, x_for=app.config["PROXY_COUNT"])
+webapp.timing.init(app)
+webapp.tracing.init(app)
+webapp.metrics.init(app)
 utils.init(app)
 webapp.user.init(app)
 utils.mail.init_app(app)
+webapp.outbox.init(app)
+webapp.throttle.init(app)
+utils.get_dbpool(app)
+webapp.compress.init(app)
 
 
 @app.errorhandler(utils.JsonException)
@@ -41,14 +65,15 @@ def setup_template_context():
 
 @app.before_request
 def prepare():
-    "Open the database connection; get the current user."
-    flask.g.dbserver = utils.get_dbserver()
-    flask.g.db = utils.get_db(dbserver=flask.g.dbserver)
+    "Get a database connection from the pool; get the current user."
+    flask.g.db = utils.get_dbpool().acquire()
+    flask.g.dbserver = flask.g.db.server
     flask.g.current_user = webapp.user.get_current_user()
     flask.g.am_admin = flask.g.current_user and \
                        flask.g.current_user["role"] == constants.ADMIN
 
 app.after_request(utils.log_access)
+app.teardown_request(utils.release_db)
 
 @app.route("/")
 def home():
@@ -58,6 +83,12 @@ def home():
     else:
         return flask.render_template("home.html")
 
+@app.route("/static/<path:filename>")
+def static(filename):
+    "Static file for the app; a precompressed variant if available."
+    return webapp.compress.send_from_directory(
+        os.path.join(app.root_path, "static"), filename)
+
 @app.route("/debug")
 @utils.admin_required
 def debug():
@@ -80,6 +111,14 @@ def status():
     "Return JSON for the current status."
     return dict(status="ok")
 
+@app.route("/metrics")
+def metrics():
+    "Return the metrics for this worker process in Prometheus text format."
+    if not webapp.metrics.allowed():
+        flask.abort(http.client.FORBIDDEN)
+    return flask.Response(webapp.metrics.get_text(),
+                          mimetype=constants.PROMETHEUS_MIMETYPE)
+
 
 # Set up the URL map.
 app.register_blueprint(webapp.about.blueprint, url_prefix="/about")
@@ -90,6 +129,7 @@ app.register_blueprint(webapp.site.blueprint, url_prefix="/site")
 
 app.register_blueprint(webapp.api.root.blueprint, url_prefix="/api")
 app.register_blueprint(webapp.api.about.blueprint, url_prefix="/api/about")
+app.register_blueprint(webapp.api.export.blueprint, url_prefix="/api/export")
 app.register_blueprint(webapp.api.schema.blueprint, url_prefix="/api/schema")
 app.register_blueprint(webapp.api.user.blueprint, url_prefix="/api/user")
 
@@ -0,0 +1,242 @@
+"""Metrics of requests and CouchDB calls, in Prometheus text format.
+Each thread updates its own shard of counters and histograms. The lock
+of a shard is only contended when the shards are summed for output,
+so that a histogram is never read half-updated.
+The metrics are per worker process.
+"""
+
+import bisect
+import threading
+import time
+
+import flask
+
+# Histogram buckets; upper bounds in seconds.
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUCHDB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# The metrics: type, help text, and histogram buckets.
+METRICS = {
+    "webapp_requests_total":
+    ("counter", "Number of requests started.", None),
+    "webapp_requests_finished_total":
+    ("counter", "Number of requests finished.", None),
+    "webapp_request_duration_seconds":
+    ("histogram", "Request duration by endpoint.", REQUEST_BUCKETS),
+    "webapp_responses_total":
+    ("counter", "Number of responses by status code.", None),
+    "webapp_couchdb_request_duration_seconds":
+    ("histogram", "CouchDB request duration by view or operation.",
+     COUCHDB_BUCKETS),
+}
+
+# Registry of caches, with 'hits' and 'misses' attributes, by name.
+_caches = {}
+
+
+class Shard:
+    "The metrics updated by one thread."
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.counters = {}      # Key: (name, labels); value: number.
+        self.histograms = {}    # Key: (name, labels); value: list, see below.
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        "The histogram list: count per bucket, then +Inf, sum and count."
+        key = (name, labels)
+        buckets = METRICS[name][2]
+        with self.lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 3)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def merge(self, other):
+        "Add the values of the other shard to this one."
+        with other.lock:
+            counters = other.counters.copy()
+            histograms = [(key, list(histogram))
+                          for key, histogram in other.histograms.items()]
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, histogram in histograms:
+            try:
+                current = self.histograms[key]
+            except KeyError:
+                self.histograms[key] = histogram
+            else:
+                for pos, value in enumerate(histogram):
+                    current[pos] += value
+
+# The shards of threads that have finished are merged into this one.
+_retired = Shard()
+_shards = []
+_lock = threading.Lock()        # For adding and retiring shards.
+_local = threading.local()
+
+# Retire the shards of finished threads after this many new shards, since
+# a server may start a thread per request, and '/metrics' may not be read.
+RETIRE_INTERVAL = 100
+_added = 0
+
+def get_shard():
+    "Return the shard of the current thread."
+    global _added
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = Shard()
+        with _lock:
+            _shards.append(shard)
+            _added += 1
+            if _added % RETIRE_INTERVAL == 0:
+                retire()
+        return shard
+
+def retire():
+    "Merge the shards of finished threads into the retired one. Lock held."
+    global _shards
+    finished = [s for s in _shards if not s.thread.is_alive()]
+    if not finished: return
+    _shards = [s for s in _shards if s.thread.is_alive()]
+    for shard in finished:
+        _retired.merge(shard)
+
+def get_totals():
+    "Return the sum of all shards; retire those of finished threads."
+    with _lock:
+        retire()
+        result = Shard()
+        result.merge(_retired)
+        for shard in _shards:
+            result.merge(shard)
+    return result
+
+def init(app):
+    "Initialize; count and time the requests."
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(teardown_request)
+
+def register_cache(name, cache):
+    "Register the cache for output of its hits and misses."
+    _caches[name] = cache
+
+def start_request():
+    "Count the request, and start timing it."
+    flask.g.metrics_start = time.perf_counter()
+    get_shard().inc("webapp_requests_total", ())
+
+def finish_request(response):
+    "Record the duration of the request and its status code."
+    if "metrics_start" in flask.g:
+        shard = get_shard()
+        endpoint = flask.request.endpoint or "none"
+        shard.observe("webapp_request_duration_seconds",
+                      (("endpoint", endpoint),),
+                      time.perf_counter() - flask.g.metrics_start)
+        shard.inc("webapp_responses_total",
+                  (("status", str(response.status_code)),))
+    return response
+
+def teardown_request(exception=None):
+    "Count the request as finished, also if an exception was raised."
+    if flask.g.pop("metrics_start", None) is not None:
+        get_shard().inc("webapp_requests_finished_total", ())
+
+def observe_couchdb(method, path, elapsed):
+    "Record the duration of a CouchDB request."
+    get_shard().observe("webapp_couchdb_request_duration_seconds",
+                        (("view", get_couchdb_label(method, path)),),
+                        elapsed)
+
+def get_couchdb_label(method, path):
+    """Return the label of the CouchDB request given its URL path:
+    the name of the view, or the special endpoint, or the operation.
+    """
+    parts = [p for p in path.split("/") if p]
+    if len(parts) >= 5 and parts[1] == "_design" and parts[3] == "_view":
+        return f"{parts[2]}/{parts[4]}"
+    if len(parts) >= 2 and parts[1].startswith("_"):
+        return parts[1]
+    if len(parts) == 1 and parts[0].startswith("_"):
+        return parts[0]
+    return f"{method} document"
+
+def get_text():
+    "Return the metrics in Prometheus text format."
+    totals = get_totals()
+    lines = []
+    for name, (kind, text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            items = [(l, v) for (n, l), v in totals.counters.items()
+                     if n == name]
+            for labels, value in sorted(items):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        else:
+            items = [(l, h) for (n, l), h in totals.histograms.items()
+                     if n == name]
+            for labels, histogram in sorted(items):
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), histogram):
+                    cumulative += count
+                    le = labels + (("le", str(bound)),)
+                    lines.append(f"{name}_bucket{format_labels(le)}"
+                                 f" {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)}"
+                             f" {histogram[-2]:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)}"
+                             f" {histogram[-1]}")
+    started = totals.counters.get(("webapp_requests_total", ()), 0)
+    finished = totals.counters.get(("webapp_requests_finished_total", ()), 0)
+    lines.append("# HELP webapp_requests_in_flight Requests in progress.")
+    lines.append("# TYPE webapp_requests_in_flight gauge")
+    lines.append(f"webapp_requests_in_flight {started - finished}")
+    for name, kind, text in [
+            ("webapp_cache_hits_total", "counter", "Cache hits."),
+            ("webapp_cache_misses_total", "counter", "Cache misses."),
+            ("webapp_cache_hit_ratio", "gauge", "Cache hit ratio.")]:
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache_name, cache in sorted(_caches.items()):
+            labels = format_labels((("cache", cache_name),))
+            hits, misses = cache.hits, cache.misses
+            if name == "webapp_cache_hits_total":
+                lines.append(f"{name}{labels} {hits}")
+            elif name == "webapp_cache_misses_total":
+                lines.append(f"{name}{labels} {misses}")
+            elif hits + misses:
+                lines.append(f"{name}{labels} {hits / (hits + misses):.4f}")
+    return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    "Return the labels in Prometheus format, with values escaped."
+    if not labels: return ""
+    items = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+def allowed():
+    """Is the current request allowed to get the metrics?
+    An admin user, or from an allowed IP address. A request forwarded by
+    a proxy is never allowed by its IP address, which is that of the proxy.
+    """
+    if flask.g.get("am_admin"): return True
+    headers = flask.request.headers
+    if "X-Forwarded-For" in headers or "Forwarded" in headers: return False
+    return flask.request.remote_addr in flask.current_app.config["METRICS_ALLOW"]
@@ -0,0 +1,261 @@
+"""Outbox for email messages. A message is stored as a document in the
+CouchDB database, and is sent by a background thread, which claims the
+messages due in batches, and sends each batch over one SMTP connection.
+A failed message is retried after a delay which doubles for each attempt.
+When the max number of attempts has been made, the message is marked
+as 'failed'. The body of a message that has been sent or has failed
+is removed from its document, since it may contain e.g. a password
+reset code.
+"""
+
+import atexit
+import collections
+import smtplib
+import threading
+
+import flask
+import flask_mail
+
+from webapp import constants
+from webapp import utils
+
+# Message statuses.
+QUEUED  = "queued"
+SENDING = "sending"
+SENT    = "sent"
+FAILED  = "failed"
+
+DESIGN_DOC = {
+    "views": {
+        "pending": {"map": "function(doc) {if (doc.doctype !== 'message') return; if (doc.status === 'queued') emit(['queued', doc.next_attempt], null); else if (doc.status === 'sending') emit(['sending', doc.claimed], null);}"},
+        "status": {"map": "function(doc) {if (doc.doctype !== 'message') return; emit([doc.status, doc.modified], null);}"},
+    }
+}
+
+# Messages kept instead of sent, when OUTBOX_CAPTURE is set; for testing.
+captured = collections.deque(maxlen=1000)
+
+def init(app):
+    "Initialize; check the CouchDB design document, start the sender."
+    db = utils.get_db(app=app)
+    utils.init_design(db, "outbox", DESIGN_DOC, utils.get_logger(app))
+    app.before_request(start_sender)
+
+def send(message):
+    """Store the flask_mail message in the outbox, and return.
+    It is sent by the background thread, or directly if so configured;
+    if that fails, the background thread retries it.
+    """
+    doc = {"_id": utils.get_iuid(),
+           "doctype": constants.DOCTYPE_MESSAGE,
+           "status": QUEUED,
+           "subject": message.subject,
+           "sender": message.sender,
+           "recipients": list(message.recipients),
+           "body": message.body,
+           "html": message.html,
+           "attempts": 0,
+           "next_attempt": utils.get_time(),
+           "created": utils.get_time()}
+    doc["modified"] = doc["created"]
+    if flask.current_app.config["OUTBOX_ASYNC"]:
+        flask.g.db.put(doc)
+        get_sender().notify()
+    else:
+        doc["status"] = SENDING
+        doc["claimed"] = doc["created"]
+        flask.g.db.put(doc)
+        get_sender().process([doc], flask.g.db)
+
+def start_sender():
+    "Start the background sender thread in this process, if not running."
+    get_sender().start()
+
+def purge(db, days, batch_size=1000):
+    """Delete the messages that were sent or failed more than
+    the given number of days ago. Return the number deleted.
+    """
+    cutoff = utils.get_time(-days * 24 * 60 * 60)
+    count = 0
+    for status in [SENT, FAILED]:
+        while True:
+            docs = [row.doc for row in db.view("outbox", "status",
+                                               startkey=[status, ""],
+                                               endkey=[status, cutoff],
+                                               limit=batch_size,
+                                               include_docs=True)]
+            if not docs: break
+            for doc in docs:
+                doc["_deleted"] = True
+            count += sum([1 for result in db.update(docs) if result[0]])
+            if len(docs) < batch_size: break
+    return count
+
+def get_message(doc):
+    "Return the flask_mail message for the outbox document."
+    return flask_mail.Message(subject=doc["subject"],
+                              sender=doc["sender"],
+                              recipients=doc["recipients"],
+                              body=doc["body"],
+                              html=doc.get("html"))
+
+
+class Sender(utils.ProcessLocal):
+    """Background sender of the messages in the outbox. Messages are claimed
+    in batches, which protects against sending a message twice when there
+    are several processes. A claim by a process that died is retried
+    after a timeout.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config["OUTBOX_BATCH_SIZE"]
+        self.interval = app.config["OUTBOX_POLL_INTERVAL"]
+        self.max_attempts = app.config["OUTBOX_MAX_ATTEMPTS"]
+        self.retry_delay = app.config["OUTBOX_RETRY_DELAY"]
+        self.claim_timeout = app.config["OUTBOX_CLAIM_TIMEOUT"]
+        self.capture = app.config["OUTBOX_CAPTURE"]
+        self.reset()
+        atexit.register(self.close)
+
+    def reset(self):
+        "Set up for a new thread."
+        super().reset()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.stopping = False
+        self.db = None
+
+    def start(self):
+        "Start the thread, if not running. A thread that has died is restarted."
+        if self.thread is not None and self.thread.is_alive(): return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive(): return
+            if self.stopping: return
+            if self.thread is not None:
+                utils.get_logger(self.app).error("outbox: sender thread died;"
+                                                 " restarting")
+                self.db = None
+            self.thread = threading.Thread(target=self.run,
+                                           name="OutboxSender",
+                                           daemon=True)
+            self.thread.start()
+
+    def notify(self):
+        "Wake up the thread; there is a new message."
+        self.start()
+        self.event.set()
+
+    def run(self):
+        "Send the messages due, when notified or after the poll interval."
+        with self.app.app_context():
+            while not self.stopping:
+                self.event.wait(self.interval)
+                self.event.clear()
+                try:
+                    if self.db is None:
+                        self.db = utils.get_db(app=self.app)
+                    while not self.stopping:
+                        docs = self.claim()
+                        if not docs: break
+                        self.process(docs, self.db)
+                except Exception as error:
+                    self.db = None
+                    utils.get_logger(self.app).error(f"outbox: {error}")
+
+    def claim(self):
+        "Claim a batch of the messages due, and return them."
+        now = utils.get_time()
+        rows = list(self.db.view("outbox", "pending",
+                                 startkey=[QUEUED, ""], endkey=[QUEUED, now],
+                                 limit=self.batch_size, include_docs=True))
+        if len(rows) < self.batch_size:
+            rows.extend(self.db.view(
+                "outbox", "pending",
+                startkey=[SENDING, ""],
+                endkey=[SENDING, utils.get_time(-self.claim_timeout)],
+                limit=self.batch_size - len(rows),
+                include_docs=True))
+        docs = [row.doc for row in rows]
+        for doc in docs:
+            doc["status"] = SENDING
+            doc["claimed"] = now
+        result = []
+        # Another process may have claimed some; those are skipped.
+        for doc, status in zip(docs, self.db.update(docs)):
+            if status[0]:
+                doc["_rev"] = status[2]
+                result.append(doc)
+        return result
+
+    def process(self, docs, db):
+        """Send the claimed messages over one SMTP connection,
+        and store their new status.
+        """
+        try:
+            if self.capture:
+                for doc in docs:
+                    captured.append(get_message(doc))
+                    self.set_sent(doc)
+            else:
+                with utils.mail.connect() as connection:
+                    for doc in docs:
+                        try:
+                            connection.send(get_message(doc))
+                        except (smtplib.SMTPRecipientsRefused,
+                                flask_mail.BadHeaderError) as error:
+                            self.set_failed(doc, error, retry=False)
+                        except (OSError, smtplib.SMTPException) as error:
+                            self.set_failed(doc, error)
+                        else:
+                            self.set_sent(doc)
+        except (OSError, smtplib.SMTPException) as error:
+            # Could not connect, or connection lost when closing.
+            for doc in docs:
+                if doc["status"] == SENDING:
+                    self.set_failed(doc, error)
+        for doc in docs:
+            doc["modified"] = utils.get_time()
+        db.update(docs)
+
+    def set_sent(self, doc):
+        "Mark the message as sent, and remove its body."
+        doc["status"] = SENT
+        doc["sent"] = utils.get_time()
+        doc["attempts"] += 1
+        doc.pop("error", None)
+        self.redact(doc)
+
+    def set_failed(self, doc, error, retry=True):
+        """Mark the message for retry after a delay, or as failed
+        if no retry or the max number of attempts has been reached.
+        """
+        doc["attempts"] += 1
+        doc["error"] = str(error)
+        if retry and doc["attempts"] < self.max_attempts:
+            doc["status"] = QUEUED
+            delay = self.retry_delay * 2 ** (doc["attempts"] - 1)
+            doc["next_attempt"] = utils.get_time(delay)
+        else:
+            doc["status"] = FAILED
+            self.redact(doc)
+            utils.get_logger(self.app).error(
+                f"outbox: message {doc['_id']} failed: {error}")
+
+    def redact(self, doc):
+        "Remove the body of the message, which will not be sent again."
+        doc["body"] = None
+        doc["html"] = None
+
+    def close(self):
+        "Stop the thread; messages not yet sent remain in the outbox."
+        if not self.in_process() or self.thread is None: return
+        self.stopping = True
+        self.event.set()
+        self.thread.join(timeout=10)
+        self.thread = None
+
+def get_sender(app=None):
+    "Get the outbox sender for this worker process, creating it if needed."
+    return utils.get_instance(Sender, app)
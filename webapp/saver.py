@@ -1,9 +1,14 @@
 "Base document saver context classes."
 
+import atexit
 import copy
 import os.path
+import queue
 import sys
+import threading
+import time
 
+import couchdb2
 import flask
 
 from . import constants
@@ -16,16 +21,30 @@ class BaseSaver:
     DOCTYPE = None
     EXCLUDE_PATHS = [["_id"], ["_rev"], ["doctype"], ["modified"]]
     HIDDEN_VALUE_PATHS = []
+    # If True, record the original values of top-level items as they are
+    # changed via item assignment or deletion on the saver, or fetched from
+    # it if they are mutable, instead of copying the entire document.
+    # All changes must then be made via the saver, not its 'doc'.
+    TRACK_CHANGES = False
 
     def __init__(self, doc=None):
+        self.exclude_paths = set([tuple(p) for p in self.EXCLUDE_PATHS])
+        self.hidden_value_paths = set([tuple(p)
+                                       for p in self.HIDDEN_VALUE_PATHS])
+        self.tracked = None
         if doc is None:
             self.original = {}
             self.doc = {"_id": utils.get_iuid(),
                         "created": utils.get_time()}
             self.initialize()
+        elif self.TRACK_CHANGES:
+            self.original = {}  # Only the original values of changed items.
+            self.tracked = set()
+            self.doc = doc
         else:
             self.original = copy.deepcopy(doc)
             self.doc = doc
+        self.errors = {}
         self.prepare()
 
     def __enter__(self):
@@ -36,15 +55,37 @@ class BaseSaver:
         self.finish()
         self.doc["doctype"] = self.DOCTYPE
         self.doc["modified"] = utils.get_time()
-        flask.g.db.put(self.doc)
-        self.add_log()
+        if flask.current_app.config["SAVER_LOG_ASYNC"]:
+            flask.g.db.put(self.doc)
+            get_log_writer().put(self.get_log_entry())
+        elif flask.current_app.config["SAVER_BULK_DOCS"]:
+            self.put_bulk()
+        else:
+            flask.g.db.put(self.doc)
+            self.add_log()
 
     def __getitem__(self, key):
-        return self.doc[key]
+        "A mutable value may be changed in place; record its original."
+        value = self.doc[key]
+        if isinstance(value, (dict, list)):
+            self.track(key)
+        return value
 
     def __setitem__(self, key, value):
+        self.track(key)
         self.doc[key] = value
 
+    def __delitem__(self, key):
+        self.track(key)
+        del self.doc[key]
+
+    def track(self, key):
+        "Record the original value of the item, if tracking changes."
+        if self.tracked is None or key in self.tracked: return
+        self.tracked.add(key)
+        if key in self.doc:
+            self.original[key] = copy.deepcopy(self.doc[key])
+
     def initialize(self):
         "Initialize the new document."
         pass
@@ -63,15 +104,51 @@ class BaseSaver:
         """
         pass
 
+    def put_bulk(self):
+        """Store the document and its log entry in one single request.
+        Errors for the individual documents are recorded in the dictionary
+        'errors', keyed by document identifier. If the document itself
+        could not be stored, the log entry is removed and an exception
+        is raised; a conflict raises couchdb2.RevisionError.
+        """
+        entry = self.get_log_entry()
+        docs = {self.doc["_id"]: self.doc, entry["_id"]: entry}
+        for result in flask.g.db.update([self.doc, entry]):
+            if result[0]:
+                docs[result[1]]["_rev"] = result[2]
+            else:
+                self.errors[result[1]] = (result[2], result[3])
+        if not self.errors: return
+        try:
+            error, reason = self.errors[self.doc["_id"]]
+        except KeyError:
+            utils.get_logger().error(f"could not store log entry for"
+                                     f" {self.doc['_id']}: {self.errors}")
+            return
+        if "_rev" in entry:
+            flask.g.db.delete(entry)
+        if error == "conflict":
+            raise couchdb2.RevisionError(reason)
+        raise couchdb2.CouchDB2Exception(f"{error}: {reason}")
+
     def add_log(self):
-        """Add a log entry recording the the difference betweens the current and
-        the original document, hiding values of specified keys.
+        "Add a log entry recording the changes of the document."
+        flask.g.db.put(self.get_log_entry())
+
+    def get_log_entry(self):
+        """Return a log entry recording the the difference betweens the current
+        and the original document, hiding values of specified keys.
         'added': list of keys for items added in the current.
         'updated': dictionary of items updated; original values.
         'removed': dictionary of items removed; original values.
         """
         self.stack = []
-        diff = self.diff(self.original, self.doc)
+        if self.tracked is None:
+            diff = self.diff(self.original, self.doc)
+        else:
+            diff = self.diff(self.original,
+                             dict([(k, self.doc[k]) for k in self.tracked
+                                   if k in self.doc]))
         entry = {"_id": utils.get_iuid(),
                  "doctype": constants.DOCTYPE_LOG,
                  "docid": self.doc["_id"],
@@ -88,7 +165,7 @@ class BaseSaver:
         else:
             entry["remote_addr"] = None
             entry["user_agent"] = os.path.basename(sys.argv[0])
-        flask.g.db.put(entry)
+        return entry
 
     def diff(self, old, new):
         """Find the differences between the old and the new documents.
@@ -101,34 +178,37 @@ class BaseSaver:
         old_keys = set(old.keys())
         for key in new_keys.difference(old_keys):
             self.stack.append(key)
-            if self.stack not in self.EXCLUDE_PATHS:
-                if self.stack in self.HIDDEN_VALUE_PATHS:
+            path = tuple(self.stack)
+            if path not in self.exclude_paths:
+                if path in self.hidden_value_paths:
                     added[key] = "<hidden>"
                 else:
                     added[key] = new[key]
             self.stack.pop()
         for key in old_keys.difference(new_keys):
             self.stack.append(key)
-            if self.stack not in self.EXCLUDE_PATHS:
-                if self.stack in self.HIDDEN_VALUE_PATHS:
+            path = tuple(self.stack)
+            if path not in self.exclude_paths:
+                if path in self.hidden_value_paths:
                     removed[key] = "<hidden>"
                 else:
                     removed[key] = old[key]
             self.stack.pop()
         for key in new_keys.intersection(old_keys):
             self.stack.append(key)
-            if self.stack not in self.EXCLUDE_PATHS:
+            path = tuple(self.stack)
+            if path not in self.exclude_paths:
                 new_value = new[key]
                 old_value = old[key]
                 if isinstance(new_value, dict) and isinstance(old_value, dict):
                     changes = self.diff(old_value, new_value)
                     if changes:
-                        if self.stack in self.HIDDEN_VALUE_PATHS:
+                        if path in self.hidden_value_paths:
                             updated[key] = "<hidden>"
                         else:
                             updated[key] = changes
                 elif new_value != old_value:
-                    if self.stack in self.HIDDEN_VALUE_PATHS:
+                    if path in self.hidden_value_paths:
                         updated[key]= dict(new_value="<hidden>",
                                            old_value="<hidden>")
                     else:
@@ -149,6 +229,138 @@ class BaseSaver:
         pass
 
 
+class LogWriter(utils.ProcessLocal):
+    """Background writer of log entries. The entries are queued and
+    stored in batches by a separate thread, when the batch is full
+    or after the flush interval.
+    When the queue is full, a caller waits for a while, and then
+    stores the entry itself. A thread that has died is restarted.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config["SAVER_LOG_BATCH_SIZE"]
+        self.interval = app.config["SAVER_LOG_INTERVAL"] / 1000.0
+        self.timeout = app.config["SAVER_LOG_PUT_TIMEOUT"]
+        self.maxsize = app.config["SAVER_LOG_QUEUE_SIZE"]
+        self.flush_timeout = app.config["SAVER_LOG_FLUSH_TIMEOUT"]
+        self.reset()
+        atexit.register(self.close)
+
+    def reset(self):
+        "Set up a new queue; a forked child must not write parent's entries."
+        super().reset()
+        self.queue = queue.Queue(maxsize=self.maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.db = None
+
+    def put(self, entry):
+        "Queue the log entry. Store it directly if the queue stays full."
+        self.start()
+        try:
+            self.queue.put(entry, timeout=self.timeout)
+        except queue.Full:
+            flask.g.db.put(entry)
+
+    def start(self):
+        "Start the thread, if not running."
+        if self.thread is not None and self.thread.is_alive(): return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive(): return
+            if self.thread is not None:
+                utils.get_logger(self.app).error("log writer thread died;"
+                                                 " restarting")
+            self.thread = threading.Thread(target=self.run,
+                                           name="LogWriter",
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        "Collect entries into batches, and store them. Stop at None."
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            try:
+                if batch:
+                    self.write(batch)
+            except Exception as error:
+                utils.get_logger(self.app).error(
+                    f"could not store {len(batch)} log entries: {error}")
+            finally:
+                for entry in batch:
+                    self.queue.task_done()
+                if stop:
+                    self.queue.task_done()
+                    return
+
+    def write(self, batch):
+        "Store the batch of entries, trying twice with a new connection."
+        for attempt in range(2):
+            try:
+                if self.db is None:
+                    self.db = utils.get_db(app=self.app)
+                results = self.db.update(batch)
+            except Exception as error:
+                self.db = None
+                failed = error
+            else:
+                failed = set([r[1] for r in results if not r[0]])
+                if not failed: return
+                batch = [e for e in batch if e["_id"] in failed]
+        logger = utils.get_logger(self.app)
+        logger.error(f"could not store {len(batch)} log entries: {failed}")
+
+    def flush(self):
+        """Wait until all queued entries have been stored, or the timeout.
+        Return False if entries remain in the queue.
+        """
+        if not self.in_process() or self.thread is None: return True
+        self.start()
+        deadline = time.monotonic() + self.flush_timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    utils.get_logger(self.app).error(
+                        f"log writer: {self.queue.unfinished_tasks}"
+                        " entries not stored after flush timeout")
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        "Store the queued entries, and stop the thread; wait at most timeout."
+        if not self.in_process() or self.thread is None: return
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=self.flush_timeout)
+            except queue.Full:
+                pass
+            else:
+                self.thread.join(timeout=self.flush_timeout)
+        self.thread = None
+
+def get_log_writer(app=None):
+    "Get the background log writer, creating it if needed."
+    return utils.get_instance(LogWriter, app)
+
+def flush_log_writer():
+    "Wait until all queued log entries have been stored, if any."
+    log_writer = utils.get_instance(LogWriter, create=False)
+    if log_writer is not None:
+        log_writer.flush()
+
+
 class AttachmentsSaver(BaseSaver):
     "Document saver context handling attachments."
 
@@ -5,6 +5,7 @@ import os.path
 
 import flask
 
+from webapp import compress
 
 blueprint = flask.Blueprint("site", __name__)
 
@@ -16,6 +17,6 @@ def static(filename):
         raise ValueError("misconfiguration: no SITE_STATIC_DIRPATH set")
     dirpath = os.path.expandvars(os.path.expanduser(dirpath))
     if dirpath:
-        return flask.send_from_directory(dirpath, filename)
+        return compress.send_from_directory(dirpath, filename)
     else:
         flask.abort(http.client.NOT_FOUND)
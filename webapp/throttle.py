@@ -0,0 +1,182 @@
+"""Throttling of failed login attempts, per username and IP address, and
+per IP address. An account can thus not be locked by failed logins from
+elsewhere. Sliding windows kept in memory, and optionally shared between
+processes via documents in the CouchDB database, which are deleted
+when expired.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+import couchdb2
+import flask
+
+from webapp import constants
+from webapp import utils
+
+DESIGN_DOC = {
+    "views": {
+        "expires": {"map": "function(doc) {if (doc.doctype !== 'throttle') return; emit(doc.expires, null);}"},
+    }
+}
+
+def init(app):
+    "Initialize; check the CouchDB design document, if shared."
+    if app.config["LOGIN_THROTTLE_SHARED"]:
+        db = utils.get_db(app=app)
+        utils.init_design(db, "throttle", DESIGN_DOC, utils.get_logger(app))
+
+
+class ThrottledError(ValueError):
+    "Too many failed login attempts."
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, int(retry_after + 0.5))
+        super().__init__("Too many failed login attempts;"
+                         f" try again in {self.retry_after} seconds.")
+
+
+class Throttle(utils.ProcessLocal):
+    """Sliding windows of the times of failed login attempts, by key.
+    The window for a key is a list of times; the least recently used keys
+    are dropped when there are too many.
+    """
+
+    def __init__(self, app):
+        self.window = app.config["LOGIN_THROTTLE_WINDOW"]
+        self.limits = dict(username=app.config["LOGIN_THROTTLE_USERNAME"],
+                           ip=app.config["LOGIN_THROTTLE_IP"])
+        self.size = app.config["LOGIN_THROTTLE_SIZE"]
+        self.shared = app.config["LOGIN_THROTTLE_SHARED"]
+        self.reset()
+
+    def reset(self):
+        "Clear the windows."
+        super().reset()
+        self.lock = threading.Lock()
+        self.windows = collections.OrderedDict()
+        self.purged = 0.0
+
+    def get_keys(self, username):
+        """Return the keys and their limits for the current request.
+        The IP address is that of the client, if the app is configured
+        for the reverse proxies in front of it.
+        """
+        result = []
+        if username and self.limits["username"]:
+            result.append((self.get_username_key(username),
+                           self.limits["username"]))
+        if flask.request.remote_addr and self.limits["ip"]:
+            result.append((f"ip:{flask.request.remote_addr}",
+                           self.limits["ip"]))
+        return result
+
+    def get_username_key(self, username):
+        "Return the key for the username from the IP address of the request."
+        return f"username:{username.lower()} ip:{flask.request.remote_addr}"
+
+    def check(self, username):
+        """Raise ThrottledError if too many failed login attempts
+        for the username or from the IP address of the request.
+        The in-memory windows are checked first, so that throttled
+        requests do not cause any database requests.
+        """
+        keys = self.get_keys(username)
+        now = time.time()
+        with self.lock:
+            for key, limit in keys:
+                times = self.get_times(self.windows.get(key), now)
+                if len(times) >= limit:
+                    raise ThrottledError(times[-limit] + self.window - now)
+        if not self.shared: return
+        for key, limit in keys:
+            doc = flask.g.db.get(get_docid(key))
+            if doc is None: continue
+            times = self.get_times(doc["times"], now)
+            if len(times) >= limit:
+                raise ThrottledError(times[-limit] + self.window - now)
+
+    def record(self, username):
+        "Record a failed login attempt for the username and IP address."
+        keys = self.get_keys(username)
+        now = time.time()
+        with self.lock:
+            for key, limit in keys:
+                times = self.get_times(self.windows.get(key), now)
+                times.append(now)
+                self.windows[key] = times[-limit:]
+                self.windows.move_to_end(key)
+            while len(self.windows) > self.size:
+                self.windows.popitem(last=False)
+        if not self.shared: return
+        try:
+            for key, limit in keys:
+                self.record_shared(key, limit, now)
+            if now - self.purged > self.window:
+                self.purged = now
+                self.purge(now)
+        except (IOError, couchdb2.CouchDB2Exception) as error:
+            utils.get_logger().warning(
+                f"could not record login throttle: {error}")
+
+    def record_shared(self, key, limit, now):
+        """Record the failed attempt in the document for the key.
+        The document expires when the last attempt is outside the window.
+        """
+        docid = get_docid(key)
+        for attempt in range(3):
+            doc = flask.g.db.get(docid) or {"_id": docid,
+                                            "doctype": constants.DOCTYPE_THROTTLE,
+                                            "times": []}
+            times = self.get_times(doc["times"], now)
+            times.append(now)
+            doc["times"] = times[-limit:]
+            doc["expires"] = now + self.window
+            try:
+                flask.g.db.put(doc)
+                return
+            except couchdb2.RevisionError:
+                pass            # Concurrent update; try again.
+
+    def purge(self, now, limit=100):
+        "Delete a batch of the expired shared documents."
+        docs = [row.doc for row in flask.g.db.view("throttle", "expires",
+                                                   endkey=now,
+                                                   limit=limit,
+                                                   include_docs=True)]
+        for doc in docs:
+            doc["_deleted"] = True
+        if docs:
+            flask.g.db.update(docs)
+
+    def clear(self, username):
+        """Forget the failed login attempts for the username
+        from the IP address of the request.
+        """
+        if not username or not self.limits["username"]: return
+        key = self.get_username_key(username)
+        with self.lock:
+            self.windows.pop(key, None)
+        if not self.shared: return
+        doc = flask.g.db.get(get_docid(key))
+        if doc is not None:
+            try:
+                flask.g.db.delete(doc)
+            except couchdb2.CouchDB2Exception:
+                pass            # Concurrent update or delete.
+
+    def get_times(self, times, now):
+        "Return a new list of the times that are within the window."
+        if not times: return []
+        return [t for t in times if t > now - self.window]
+
+def get_docid(key):
+    "Return the document id for the key; IP addresses are not stored as such."
+    return "throttle_" + hashlib.blake2b(key.encode("utf-8"),
+                                         digest_size=16).hexdigest()
+
+def get_throttle(app=None):
+    "Get the login throttle for this worker process, creating it if needed."
+    return utils.get_instance(Throttle, app)
@@ -0,0 +1,79 @@
+"""Per-request timing: wall time, CPU time of the request thread, and the
+number and duration of CouchDB calls, template renderings and password
+hash operations. Reported in the access log and the Server-Timing header.
+"""
+
+import time
+
+import flask
+
+# The items measured, and their descriptions in the Server-Timing header.
+ITEMS = [("db", "CouchDB"),
+         ("render", "Templates"),
+         ("hash", "Password hashing")]
+
+def init(app):
+    "Initialize; start timing before request, measure template rendering."
+    app.before_request(start)
+    flask.before_render_template.connect(start_render, app)
+    flask.template_rendered.connect(finish_render, app)
+
+def start():
+    "Start the timing of the request."
+    flask.g.timing = dict(start=time.perf_counter(),
+                          cpu=time.thread_time(),
+                          render_starts=[])
+    for name, description in ITEMS:
+        flask.g.timing[name] = [0, 0.0]
+
+def add(name, elapsed):
+    "Add the elapsed time (seconds) for the named item, if timing a request."
+    if not flask.has_request_context(): return
+    timing = flask.g.get("timing")
+    if timing is None: return
+    timing[name][0] += 1
+    timing[name][1] += elapsed
+
+def start_render(sender, template, context, **extra):
+    "Record the start of a template rendering."
+    if "timing" in flask.g:
+        flask.g.timing["render_starts"].append(time.perf_counter())
+
+def finish_render(sender, template, context, **extra):
+    "Add the time of the template rendering."
+    if "timing" in flask.g and flask.g.timing["render_starts"]:
+        start = flask.g.timing["render_starts"].pop()
+        add("render", time.perf_counter() - start)
+
+def finish(response):
+    """Finish the timing of the request. Set the Server-Timing header,
+    if so configured, and only for admin users; the timings reveal
+    e.g. whether a password hash was checked. Return a dictionary of the
+    counts and durations (milliseconds), or None if the request was not timed.
+    """
+    timing = flask.g.get("timing")
+    if timing is None: return None
+    result = dict(total=1000 * (time.perf_counter() - timing["start"]),
+                  cpu=1000 * (time.thread_time() - timing["cpu"]))
+    for name, description in ITEMS:
+        result[name] = 1000 * timing[name][1]
+        result[name + "_count"] = timing[name][0]
+    if flask.current_app.config["SERVER_TIMING"] and flask.g.get("am_admin"):
+        metrics = [f"total;dur={result['total']:.1f}",
+                   f"cpu;dur={result['cpu']:.1f}"]
+        for name, description in ITEMS:
+            if result[name + "_count"]:
+                metrics.append(f"{name};dur={result[name]:.1f};"
+                               f'desc="{description} x{result[name + "_count"]}"')
+        response.headers["Server-Timing"] = ", ".join(metrics)
+    return result
+
+def get_summary(timings):
+    "Return the timings as a string for the access log."
+    if timings is None: return ""
+    parts = [f"{timings['total']:.0f}ms", f"cpu={timings['cpu']:.0f}ms"]
+    for name, description in ITEMS:
+        if timings[name + "_count"]:
+            parts.append(f"{name}={timings[name + '_count']}/"
+                         f"{timings[name]:.0f}ms")
+    return " ".join(parts)
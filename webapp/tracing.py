@@ -0,0 +1,111 @@
+"""Tracing of the CouchDB calls: the operation, the view or document,
+the shape of the key, the number of rows, bytes sent and received,
+and the duration. The most recent calls are kept in memory, for the
+admin page listing the slowest. Slow calls are written to a separate log.
+"""
+
+import collections
+import logging
+import time
+
+import flask
+
+from webapp import metrics
+from webapp import utils
+
+# The most recent calls; set up by 'init'.
+_recent = None
+_threshold = None
+_slow_logger = None
+
+def init(app):
+    "Initialize; set up the memory of recent calls and the slow-query log."
+    global _recent, _threshold, _slow_logger
+    if app.config["COUCHDB_TRACE_SIZE"]:
+        _recent = collections.deque(maxlen=app.config["COUCHDB_TRACE_SIZE"])
+    _threshold = app.config["COUCHDB_SLOW_THRESHOLD"]
+    _slow_logger = logging.getLogger(app.config["LOG_NAME"] + ".slow")
+    _slow_logger.setLevel(logging.WARNING)
+    if app.config["COUCHDB_SLOW_LOG_FILEPATH"]:
+        if app.config["LOG_JSON"]:
+            formatter = utils.JsonFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s %(message)s")
+        _slow_logger.addHandler(utils.get_log_handler(
+            app.config, app.config["COUCHDB_SLOW_LOG_FILEPATH"], formatter))
+        _slow_logger.propagate = False
+
+def record(method, path, params, status, sent, received, elapsed):
+    """Record the call, and log it if slow. The status is the HTTP status
+    code, or the name of the exception if the call failed. Return the entry,
+    which is completed when the response is decoded, or None if tracing
+    is not enabled.
+    """
+    if _recent is None and not _threshold: return None
+    if flask.has_request_context():
+        endpoint = flask.request.endpoint or flask.request.path
+    else:
+        endpoint = None
+    entry = dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                 operation=method,
+                 target=metrics.get_couchdb_label(method, path),
+                 key=get_key_shape(params),
+                 status=status,
+                 rows=None,
+                 sent=sent,
+                 received=received,
+                 ms=round(1000 * elapsed, 1),
+                 endpoint=endpoint)
+    entry["slow"] = bool(_threshold and entry["ms"] >= _threshold)
+    if _recent is not None:
+        _recent.append(entry)
+    if entry["slow"]:
+        _slow_logger.warning(" ".join([f"{key}={entry[key]}" for key in
+                                       ["ms", "operation", "target", "key",
+                                        "status", "sent", "received",
+                                        "endpoint"]]),
+                             extra={"data": entry})
+    return entry
+
+def finish(entry, data=None):
+    """Set the number of rows from the decoded response. The slow-query
+    log has already been written; the rows are shown on the admin page.
+    """
+    if entry is None: return
+    if isinstance(data, dict):
+        for key in ["rows", "docs", "results"]:
+            if isinstance(data.get(key), list):
+                entry["rows"] = len(data[key])
+                break
+    elif isinstance(data, list):
+        entry["rows"] = len(data)
+
+def get_key_shape(params):
+    """Return the shape of the view key parameters, which are JSON values,
+    and the other parameters as such.
+    """
+    if not params: return None
+    result = []
+    for name, value in sorted(params.items()):
+        if name in ("key", "keys", "startkey", "endkey",
+                    "start_key", "end_key"):
+            value = str(value)
+            if value.startswith("["):
+                value = "array"
+            elif value.startswith("{"):
+                value = "object"
+            elif value.startswith('"'):
+                value = "string"
+            elif value in ("null", "true", "false"):
+                pass
+            else:
+                value = "number"
+        result.append(f"{name}:{value}")
+    return ",".join(result)
+
+def get_slowest(number):
+    "Return the slowest of the recent calls; most recent call first if equal."
+    if _recent is None: return []
+    entries = list(_recent)
+    entries.reverse()
+    return sorted(entries, key=lambda e: e["ms"], reverse=True)[:number]
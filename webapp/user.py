@@ -1,33 +1,147 @@
 "User display and login/logout HTMl endpoints."
 
+import copy
 import fnmatch
+import hashlib
 import http.client
 import json
+import os
+import threading
+import time
 
+import couchdb2
 import flask
 import flask_mail
-from werkzeug.security import check_password_hash, generate_password_hash
 
 from webapp import constants
+from webapp import hashing
+from webapp import metrics
+from webapp import outbox
+from webapp import throttle
 from webapp import utils
 from webapp.saver import BaseSaver
 
 def init(app):
-    "Initialize; update CouchDB design document."
+    "Initialize; set up the user cache, check CouchDB design document."
+    global _user_cache, _user_cache_revalidate
+    _user_cache = utils.Cache(app.config["USER_CACHE_TTL"],
+                              app.config["USER_CACHE_SIZE"])
+    _user_cache_revalidate = app.config["USER_CACHE_REVALIDATE"]
+    metrics.register_cache("users", _user_cache)
     db = utils.get_db(app=app)
     logger = utils.get_logger(app)
-    if db.put_design("users", DESIGN_DOC):
-        logger.info("Updated users design document.")
+    utils.init_design(db, "users", DESIGN_DOC, logger)
+    utils.init_indexes(db, MANGO_DDOC, MANGO_INDEXES, logger)
+    apikey_filter.refresh = app.config["USER_APIKEY_FILTER_REFRESH"]
+    if apikey_filter.refresh:
+        apikey_filter.load(db)
 
 DESIGN_DOC = {
     "views": {
         "username": {"map": "function(doc) {if (doc.doctype !== 'user') return; emit(doc.username.toLowerCase(), null);}"},
         "email": {"map": "function(doc) {if (doc.doctype !== 'user') return;  emit(doc.email, null);}"},
         "apikey": {"map": "function(doc) {if (doc.doctype !== 'user') return;  emit(doc.apikey, null);}"},
-        "role": {"map": "function(doc) {if (doc.doctype !== 'user') return;  emit(doc.role, null);}"},
+        "role": {"map": "function(doc) {if (doc.doctype !== 'user') return;  emit([doc.role, doc.username.toLowerCase()], null);}"},
+        "status": {"map": "function(doc) {if (doc.doctype !== 'user') return;  emit([doc.status, doc.username.toLowerCase()], null);}"},
+        "modified": {"map": "function(doc) {if (doc.doctype !== 'user') return;  emit([doc.modified, doc.username.toLowerCase()], null);}"},
     },
 }
 
+# Mango indexes; created in the design document given below.
+MANGO_DDOC = "users_mango"
+MANGO_INDEXES = {
+    "email": {"fields": ["email"],
+              "selector": {"doctype": constants.DOCTYPE_USER}},
+    "apikey": {"fields": ["apikey"],
+               "selector": {"doctype": constants.DOCTYPE_USER}},
+    "role_status": {"fields": ["role", "status"],
+                    "selector": {"doctype": constants.DOCTYPE_USER}},
+}
+
+# Cache of current users, keyed by username and by API key.
+_user_cache = None
+_user_cache_revalidate = None
+
+
+class ApikeyFilter:
+    """Set of short hashes of all API keys in the database, for rejecting
+    unknown API keys without a database lookup. A hash collision merely
+    lets an unknown key through to the database lookup.
+    Only valid for a single worker process: an API key set by another
+    process is rejected until the set is reloaded. The filter is disabled
+    in a process forked after loading it. Disabled until loaded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loading = threading.Lock()
+        self.digests = None
+        self.added = set()
+        self.removed = set()
+        self.loaded = None
+        self.refresh = None
+        self.pid = None
+
+    def digest(self, apikey):
+        return hashlib.blake2b(apikey.encode(), digest_size=8).digest()
+
+    def load(self, db):
+        """Load the hashes of all API keys from the database.
+        Only one thread at a time loads; the new set is swapped in.
+        """
+        with self.loading:
+            with self.lock:
+                self.added = set()
+                self.removed = set()
+            digests = set([self.digest(r.key)
+                           for r in db.view("users", "apikey") if r.key])
+            with self.lock:
+                # Keep changes made in this process while loading.
+                digests.update(self.added)
+                digests.difference_update(self.removed)
+                self.digests = digests
+                self.loaded = time.monotonic()
+                self.pid = os.getpid()
+
+    def may_contain(self, apikey):
+        """Is the API key possibly valid? If not in the set, and the set
+        is too old, reload it, unless another thread is doing so,
+        in which case the API key is possibly valid.
+        """
+        if self.digests is None: return True
+        if self.pid != os.getpid():
+            # Forked: there are several worker processes.
+            self.digests = None
+            utils.get_logger().warning("API key filter disabled; it requires"
+                                       " a single worker process.")
+            return True
+        digest = self.digest(apikey)
+        if digest in self.digests: return True
+        if time.monotonic() - self.loaded <= self.refresh: return False
+        if self.loading.locked(): return True
+        try:
+            self.load(flask.g.db)
+        except (IOError, couchdb2.CouchDB2Exception) as error:
+            utils.get_logger().warning(f"could not load API keys: {error}")
+            return True
+        return digest in self.digests
+
+    def add(self, apikey):
+        if self.digests is None: return
+        with self.lock:
+            self.digests.add(self.digest(apikey))
+            self.added.add(self.digest(apikey))
+            self.removed.discard(self.digest(apikey))
+
+    def discard(self, apikey):
+        if self.digests is None: return
+        with self.lock:
+            self.digests.discard(self.digest(apikey))
+            self.removed.add(self.digest(apikey))
+            self.added.discard(self.digest(apikey))
+
+apikey_filter = ApikeyFilter()
+
 blueprint = flask.Blueprint("user", __name__)
 
 @blueprint.route("/login", methods=["GET", "POST"])
@@ -42,7 +156,14 @@ def login():
         password = flask.request.form.get("password")
         try:
             if username and password:
-                do_login(username, password)
+                throttle.get_throttle().check(username)
+                try:
+                    do_login(username, password)
+                except hashing.BusyError:
+                    raise
+                except ValueError:
+                    throttle.get_throttle().record(username)
+                    raise
             else:
                 raise ValueError
             try:
@@ -51,6 +172,8 @@ def login():
                 return flask.redirect(flask.url_for("home"))
             else:
                 return flask.redirect(next)
+        except (hashing.BusyError, throttle.ThrottledError) as error:
+            return utils.error(error)
         except ValueError:
             return utils.error("Invalid user or password, or account disabled.")
 
@@ -126,7 +249,7 @@ def register():
                                 username=user["username"],
                                 _external=True)
             message.body = f"To enable the user account, go to {url}"
-            utils.mail.send(message)
+            outbox.send(message)
             utils.get_logger().info(f"pending user {user['username']}")
             utils.flash_message("User account created; an email will be sent"
                                 " when it has been enabled by the admin.")
@@ -177,6 +300,7 @@ def password():
             try:
                 username = flask.request.form.get("username") or ""
                 if not username: raise ValueError
+                throttle.get_throttle().check(username)
                 user = get_user(username=username)
                 if user is None: raise ValueError
                 if am_admin_and_not_self(user):
@@ -186,9 +310,13 @@ def password():
                     if user["password"] != f"code:{code}": raise ValueError
                 else:
                     password = flask.request.form.get("current_password") or ""
-                    if not check_password_hash(user["password"], password):
+                    if not hashing.check_password_hash(user["password"],
+                                                       password):
                         raise ValueError
+            except (hashing.BusyError, throttle.ThrottledError):
+                raise
             except ValueError:
+                throttle.get_throttle().record(username)
                 if flask.current_app.config["MAIL_SERVER"]:
                     raise ValueError("No such user or wrong code.")
                 else:
@@ -199,16 +327,21 @@ def password():
             if not flask.current_app.config["MAIL_SERVER"]:
                 if password != flask.request.form.get("confirm_password"):
                     raise ValueError("Wrong password entered; confirm failed.")
+            with UserSaver(user) as saver:
+                saver.set_password(password)
         except ValueError as error:
             return utils.error(error, flask.url_for(".password",
                                                     username=username,
                                                     code=code))
-        else:
-            with UserSaver(user) as saver:
-                saver.set_password(password)
-            utils.get_logger().info(f"password user {user['username']}")
-            if not flask.g.current_user:
+        utils.get_logger().info(f"password user {user['username']}")
+        if not flask.g.current_user:
+            try:
                 do_login(username, password)
+            except hashing.BusyError as error:
+                return utils.error(error, flask.url_for(".login"))
+            except ValueError:
+                return utils.error("Password set, but login failed.",
+                                   flask.url_for(".login"))
         return flask.redirect(flask.url_for("home"))
 
 @blueprint.route("/display/<identifier:username>")
@@ -220,7 +353,22 @@ def display(username):
         return utils.error("No such user.")
     if not am_admin_or_self(user):
         return utils.error("Access not allowed.")
-    return flask.render_template("user/display.html", user=user)
+    # The page depends on the user viewing it, and its CSRF token.
+    # It must not be cached if there are flashed messages to show.
+    etag = None
+    if "_flashes" not in flask.session and "_csrf_token" in flask.session:
+        etag = utils.get_etag(constants.VERSION,
+                              user["_rev"],
+                              flask.g.current_user["_id"],
+                              flask.g.current_user["_rev"],
+                              flask.session["_csrf_token"])
+        response = utils.not_modified(etag)
+        if response: return response
+    response = flask.make_response(
+        flask.render_template("user/display.html", user=user))
+    if etag:
+        utils.set_etag(response, etag)
+    return response
 
 @blueprint.route("/display/<identifier:username>/edit",
                  methods=["GET", "POST", "DELETE"])
@@ -258,6 +406,9 @@ def edit(username):
         for log in utils.get_logs(user["_id"], cleanup=False):
             flask.g.db.delete(log)
         flask.g.db.delete(user)
+        uncache_user(user)
+        if user.get("apikey"):
+            apikey_filter.discard(user["apikey"])
         utils.flash_message(f"Deleted user {username}.")
         utils.get_logger().info(f"deleted user {username}")
         if flask.g.am_admin:
@@ -274,19 +425,122 @@ def logs(username):
         return utils.error("No such user.")
     if not am_admin_or_self(user):
         return utils.error("Access not allowed.")
+    try:
+        limit = utils.get_page_limit()
+        logs, cursor = utils.get_logs_page(user["_id"], limit,
+                                           flask.request.args.get("cursor"))
+    except ValueError as error:
+        return utils.error(error)
+    if cursor:
+        next_url = flask.url_for(".logs", username=user["username"],
+                                 limit=flask.request.args.get("limit"),
+                                 cursor=cursor)
+    else:
+        next_url = None
     return flask.render_template(
         "logs.html",
         title=f"User {user['username']}",
         cancel_url=flask.url_for(".display", username=user["username"]),
         api_logs_url=flask.url_for("api_user.logs", username=user["username"]),
-        logs=utils.get_logs(user["_id"]))
+        logs=logs,
+        next_url=next_url)
 
 @blueprint.route("/all")
 @utils.admin_required
 def all():
-    "Display list of all users."
-    users = get_users()
-    return flask.render_template("user/all.html", users=users)
+    "Display list of all users. The data is fetched page by page."
+    return flask.render_template("user/all.html")
+
+# The views used for sorting the users on the given column. The keys
+# are unique, with the username added where needed, so that the page
+# cursor never has to skip rows.
+SORT_VIEWS = {"username": "username",
+              "email": "email",
+              "role": "role",
+              "status": "status",
+              "modified": "modified"}
+
+@blueprint.route("/all/data")
+@utils.admin_required
+def all_data():
+    """Return JSON for a page of the list of all users according to
+    the DataTables server-side processing protocol. The page following
+    this one is fetched using the returned cursor, given as an extra
+    parameter; without a cursor, rows are skipped to the start.
+    """
+    args = flask.request.args
+    try:
+        draw = int(args.get("draw", 0))
+        start = max(0, int(args.get("start", 0)))
+        length = int(args.get("length", 25))
+        if length < 0 or length > flask.current_app.config["PAGE_MAX_LIMIT"]:
+            length = flask.current_app.config["PAGE_MAX_LIMIT"]
+        column = args.get("order[0][column]", "0")
+        column = args.get(f"columns[{column}][data]", "username")
+        if column not in SORT_VIEWS:
+            column = "username"
+        descending = args.get("order[0][dir]") == "desc"
+        cursor = args.get("cursor")
+        if cursor:
+            cursor = utils.decode_cursor(cursor)
+    except ValueError:
+        flask.abort(http.client.BAD_REQUEST)
+    total = utils.view("users", "username",
+                       read="users_list", limit=0).total_rows
+    search = (args.get("search[value]") or "").strip().lower()
+    if search:
+        # Prefix search on username or email; the number of matches
+        # is bounded, since they must all be fetched for sorting.
+        limit = flask.current_app.config["USER_SEARCH_LIMIT"]
+        users = {}
+        for viewname in ["username", "email"]:
+            for row in utils.view("users", viewname,
+                                  read="users_list",
+                                  startkey=search,
+                                  endkey=search + "\ufff0",
+                                  limit=limit,
+                                  include_docs=True):
+                users[row.id] = row.doc
+        users = sorted(users.values(),
+                       key=lambda u: (u.get(column) or "").lower(),
+                       reverse=descending)[:limit]
+        filtered = len(users)
+        users = users[start:start+length]
+        cursor = None
+    else:
+        filtered = total
+        if cursor or not start:
+            rows, cursor = utils.get_view_page("users", SORT_VIEWS[column],
+                                               length,
+                                               cursor=cursor,
+                                               read="users_list",
+                                               descending=descending,
+                                               include_docs=True)
+        else:
+            rows = list(utils.view("users", SORT_VIEWS[column],
+                                   read="users_list",
+                                   skip=start,
+                                   limit=length,
+                                   descending=descending,
+                                   include_docs=True))
+            cursor = None
+        users = [r.doc for r in rows]
+    return get_all_data_response(draw, total, filtered, users, cursor)
+
+def get_all_data_response(draw, total, filtered, users, cursor=None):
+    "Return the JSON response for the page of users in DataTables format."
+    data = [{"username": u["username"],
+             "href": flask.url_for(".display", username=u["username"]),
+             "email": u["email"],
+             "role": u["role"],
+             "status": u["status"],
+             "modified": u["modified"]}
+            for u in users]
+    return flask.jsonify(draw=draw,
+                         recordsTotal=total,
+                         recordsFiltered=filtered,
+                         data=data,
+                         cursor=cursor and utils.encode_cursor(cursor))
 
 @blueprint.route("/enable/<identifier:username>", methods=["POST"])
 @utils.admin_required
@@ -325,13 +579,27 @@ class UserSaver(BaseSaver):
 
     DOCTYPE = constants.DOCTYPE_USER
     HIDDEN_VALUE_PATHS = [["password"]]
+    TRACK_CHANGES = True
+
+    def __exit__(self, etyp, einst, etb):
+        "Invalidate the cached user, for both old and new username and API key."
+        try:
+            result = super().__exit__(etyp, einst, etb)
+        finally:
+            uncache_user(self.original)
+            uncache_user(self.doc)
+        if etyp is None:
+            apikey = self.original.get("apikey")
+            if apikey and apikey != self.doc.get("apikey"):
+                apikey_filter.discard(apikey)
+        return result
 
     def initialize(self):
         "Set the status for a new user."
         if flask.current_app.config["USER_ENABLE_IMMEDIATELY"]:
-            self.doc["status"] = constants.ENABLED
+            self["status"] = constants.ENABLED
         else:
-            self.doc["status"] = constants.PENDING
+            self["status"] = constants.PENDING
 
     def finalize(self):
         "Check that required fields have been set."
@@ -347,7 +615,7 @@ class UserSaver(BaseSaver):
             raise ValueError("Invalid username; must be an identifier.")
         if get_user(username=username):
             raise ValueError("Username already in use.")
-        self.doc["username"] = username
+        self["username"] = username
 
     def set_email(self, email):
         email = email.lower()
@@ -355,7 +623,7 @@ class UserSaver(BaseSaver):
             raise ValueError("Invalid email.")
         if get_user(email=email):
             raise ValueError("Email already in use.")
-        self.doc["email"] = email
+        self["email"] = email
         if self.doc.get("status") == constants.PENDING:
             for expr in flask.current_app.config["USER_ENABLE_EMAIL_WHITELIST"]:
                 if fnmatch.fnmatch(email, expr):
@@ -365,27 +633,27 @@ class UserSaver(BaseSaver):
     def set_status(self, status):
         if status not in constants.USER_STATUSES:
             raise ValueError("Invalid status.")
-        self.doc["status"] = status
+        self["status"] = status
 
     def set_role(self, role):
         if role not in constants.USER_ROLES:
             raise ValueError("Invalid role.")
-        self.doc["role"] = role
+        self["role"] = role
 
     def set_password(self, password=None):
         "Set the password; a one-time code if no password provided."
         config = flask.current_app.config
         if password is None:
-            self.doc["password"] = "code:%s" % utils.get_iuid()
+            self["password"] = "code:%s" % utils.get_iuid()
         else:
             if len(password) < config["MIN_PASSWORD_LENGTH"]:
                 raise ValueError("Password too short.")
-            self.doc["password"] = generate_password_hash(
-                password, salt_length=config["SALT_LENGTH"])
+            self["password"] = hashing.generate_password_hash(password)
 
     def set_apikey(self):
         "Set a new API key."
-        self.doc["apikey"] = utils.get_iuid()
+        self["apikey"] = utils.get_iuid()
+        apikey_filter.add(self.doc["apikey"])
 
 
 # Utility functions
@@ -395,56 +663,111 @@ def get_user(username=None, email=None, apikey=None):
     Return None if no such user.
     """
     if username:
-        rows = flask.g.db.view("users", "username", 
-                               key=username.lower(), include_docs=True)
+        # Mango indexes cannot fold case; use the JavaScript view.
+        docs = [r.doc for r in flask.g.db.view("users", "username",
+                                               key=username.lower(),
+                                               include_docs=True)]
     elif email:
-        rows = flask.g.db.view("users", "email",
-                               key=email.lower(), include_docs=True)
+        docs = utils.find(MANGO_DDOC, "email",
+                          {"doctype": constants.DOCTYPE_USER,
+                           "email": email.lower()},
+                          limit=2)
     elif apikey:
-        rows = flask.g.db.view("users", "apikey", 
-                               key=apikey, include_docs=True)
+        if not apikey_filter.may_contain(apikey): return None
+        docs = utils.find(MANGO_DDOC, "apikey",
+                          {"doctype": constants.DOCTYPE_USER,
+                           "apikey": apikey},
+                          limit=2)
     else:
         return None
-    if len(rows) == 1:
-        return rows[0].doc
+    if len(docs) == 1:
+        return docs[0]
     else:
         return None
 
-def get_users(role=None, status=None):
-    "Get the users optionally specified by role and status."
+def get_users(role=None, status=None, limit=None, skip=None, read=None):
+    """Get the users optionally specified by role and status.
+    The named read may be configured for stale reads.
+    """
     assert role is None or role in constants.USER_ROLES
     assert status is None or status in constants.USER_STATUSES
+    selector = {"doctype": constants.DOCTYPE_USER}
     if role is None:
-        result = [r.doc for r in 
-                  flask.g.db.view("users", "role", include_docs=True)]
+        selector["role"] = {"$gt": None}   # Range over all roles.
     else:
-        result = [r.doc for r in 
-                  flask.g.db.view("users", "role", key=role, include_docs=True)]
+        selector["role"] = role
     if status is not None:
-        result = [d for d in result if d["status"] == status]
-    return result
+        selector["status"] = status
+    return utils.find(MANGO_DDOC, "role_status", selector,
+                      limit=limit, skip=skip, read=read)
 
 def get_current_user():
     """Return the user for the current session.
     Return None if no such user, or disabled.
+    The user is cached across requests; the cache entry is invalidated
+    when the user is saved in this process. After a short while, its
+    revision is checked against the database, which is cheaper than
+    fetching the document, in order to pick up changes made by other
+    processes, such as disabling the account or a new API key.
     """
-    user = get_user(username=flask.session.get("username"),
-                    apikey=flask.request.headers.get("x-apikey"))
+    username = flask.session.get("username")
+    apikey = flask.request.headers.get("x-apikey")
+    if username:
+        key = ("username", username.lower())
+    elif apikey:
+        key = ("apikey", apikey)
+    else:
+        key = None
+    user = None
+    if key and _user_cache is not None:
+        entry = _user_cache.get(key)
+        if entry is not None:
+            user, checked = entry
+            now = time.monotonic()
+            if now - checked > _user_cache_revalidate:
+                if utils.get_rev(user["_id"]) == user["_rev"]:
+                    _user_cache.set(key, (user, now))
+                else:
+                    _user_cache.delete(key)
+                    user = None
+    if user is None:
+        user = get_user(username=username, apikey=apikey)
+        if user is not None and key and _user_cache is not None:
+            _user_cache.set(key, (user, time.monotonic()))
+    if user is not None:
+        user = copy.deepcopy(user) # Protect the cached copy.
     if user is None or user["status"] != constants.ENABLED:
         flask.session.pop("username", None)
         return None
     return user
 
+def uncache_user(user):
+    "Remove the given user from the cache of current users."
+    if _user_cache is None: return
+    if user.get("username"):
+        _user_cache.delete(("username", user["username"].lower()))
+    if user.get("apikey"):
+        _user_cache.delete(("apikey", user["apikey"]))
+
 def do_login(username, password):
     """Set the session cookie if successful login.
     Raise ValueError if some problem.
     """
     user = get_user(username=username)
     if user is None: raise ValueError
-    if not check_password_hash(user["password"], password):
+    if not hashing.check_password_hash(user["password"], password):
         raise ValueError
     if user["status"] != constants.ENABLED:
         raise ValueError
+    # Rehash the password if the method or its cost has been changed.
+    if hashing.needs_rehash(user["password"]):
+        try:
+            with UserSaver(user) as saver:
+                saver.set_password(password)
+        except (IOError, ValueError, couchdb2.CouchDB2Exception) as error:
+            utils.get_logger().warning(f"could not rehash password for"
+                                       f" {user['username']}: {error}")
+    throttle.get_throttle().clear(username)
     flask.session["username"] = user["username"].lower()
     flask.session.permanent = True
     utils.get_logger().info(f"logged in {user['username']}")
@@ -459,7 +782,7 @@ def send_password_code(user, action):
                         code=user["password"][len("code:"):],
                         _external=True)
     message.body = f"To set your password, go to {url}"
-    utils.mail.send(message)
+    outbox.send(message)
 
 def is_empty(user):
     "Is the given user account empty? No data associated with it."
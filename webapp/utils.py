@@ -1,10 +1,20 @@
 "Various utility functions and classes."
 
+import atexit
+import base64
+import collections
+import copy
 import datetime
 import functools
+import hashlib
 import http.client
 import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
 import time
 import uuid
 
@@ -15,21 +25,132 @@ import jinja2.utils
 import werkzeug.routing
 
 from webapp import constants
+from webapp import jsonprovider
+from webapp import timing
 
 def init(app):
     """Initialize app.
     - Add URL map converters.
     - Add template filters.
-    - Update CouchDB design document.
+    - Check the CouchDB design document.
     """
     app.url_map.converters["identifier"] = IdentifierConverter
     app.url_map.converters["iuid"] = IuidConverter
     app.add_template_filter(thousands)
     app.add_template_filter(tojson2)
     db = get_db(app=app)
-    logger = get_logger(app)
-    if db.put_design("logs", DESIGN_DOC):
-        logger.info("Updated logs design document.")
+    init_design(db, "logs", DESIGN_DOC, get_logger(app))
+
+# Registry of design documents and Mango indexes used by the app.
+_designs = {}
+_indexes = {}
+
+def init_design(db, name, doc, logger):
+    """Register the design document. Store it if not in the database.
+    If it is out of date, log a warning; it must be deployed using the
+    command-line interface, which avoids blocking requests on view builds.
+    """
+    _designs[name] = doc
+    current = db.get(f"_design/{name}")
+    if current is None:
+        db.put_design(name, get_versioned_design(doc), rebuild=False)
+        logger.info(f"Stored {name} design document.")
+    elif current.get("content_hash") != get_design_hash(doc):
+        logger.warning(f"The {name} design document is out of date;"
+                       " deploy using the command-line interface.")
+
+def init_indexes(db, ddoc, indexes, logger):
+    "Register the Mango indexes. Create those not in the database."
+    _indexes[ddoc] = indexes
+    for name in put_indexes(db, ddoc, indexes):
+        logger.info(f"Created Mango index {name} in {ddoc}.")
+
+def get_design_hash(doc):
+    "Return the hash of the content of the design document."
+    content = dict([(k, doc[k]) for k in ["language", "views", "options"]
+                    if k in doc])
+    data = json.dumps(content, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()[:16]
+
+def get_versioned_design(doc):
+    "Return a copy of the design document, with its content hash."
+    result = copy.deepcopy(doc)
+    result["content_hash"] = get_design_hash(doc)
+    return result
+
+def deploy_designs(db, log=None):
+    """Deploy all registered design documents and Mango indexes.
+    A changed design document is first stored under a staging name, and
+    its views are queried, which returns only when the indexes have been
+    built. Then it is stored under its proper name; CouchDB reuses the
+    built indexes, since the views are identical.
+    """
+    log = log or (lambda message: None)
+    for name, doc in _designs.items():
+        doc = get_versioned_design(doc)
+        current = db.get(f"_design/{name}")
+        if current and current.get("content_hash") == doc["content_hash"]:
+            log(f"The {name} design document is up to date.")
+            continue
+        staging = f"{name}_staging"
+        db.put_design(staging, copy.deepcopy(doc), rebuild=False)
+        log(f"Building the views of the {staging} design document...")
+        for view in doc.get("views", {}):
+            db.view(staging, view, limit=1)
+        db.put_design(name, copy.deepcopy(doc), rebuild=False)
+        for view in doc.get("views", {}):
+            db.view(name, view, limit=1)
+        db.delete(db.get(f"_design/{staging}"))
+        db.view_cleanup()
+        log(f"Deployed the {name} design document.")
+    for ddoc, indexes in _indexes.items():
+        for name in put_indexes(db, ddoc, indexes):
+            log(f"Created Mango index {name} in {ddoc}.")
+        for name, index in indexes.items():
+            selector = dict(index.get("selector") or {})
+            selector[index["fields"][0]] = {"$gt": None}
+            db.find(selector, limit=1, use_index=[ddoc, name])
+        log(f"Built the Mango indexes in {ddoc}.")
+
+def put_indexes(db, ddoc, indexes):
+    """Create the declared Mango indexes in the given design document,
+    unless they already exist. Return the names of the created indexes.
+    Each index is declared as a dictionary with the item 'fields', and
+    optionally 'selector' giving a partial filter selector.
+    """
+    result = []
+    for name, index in indexes.items():
+        response = db.put_index(index["fields"], ddoc=ddoc, name=name,
+                                selector=index.get("selector"))
+        if response.get("result") == "created":
+            result.append(name)
+    return result
+
+def find(ddoc, name, selector, limit=None, skip=None, sort=None, fields=None,
+         read=None):
+    """Return the documents matching the Mango selector, using the named
+    index in the given design document. If no limit is given, fetch all
+    matching documents in batches. If the named read is configured for
+    stale reads, the index is not updated before returning the result.
+    """
+    update = get_stale_read(read) is None
+    if limit is not None:
+        return flask.g.db.find(selector, limit=limit, skip=skip, sort=sort,
+                               fields=fields, use_index=[ddoc, name],
+                               update=update)["docs"]
+    result = []
+    batch_size = flask.current_app.config["FIND_BATCH_SIZE"]
+    bookmark = None
+    while True:
+        response = flask.g.db.find(selector, limit=batch_size, skip=skip,
+                                   sort=sort, fields=fields,
+                                   use_index=[ddoc, name], bookmark=bookmark,
+                                   update=update)
+        result.extend(response["docs"])
+        if len(response["docs"]) < batch_size: break
+        bookmark = response["bookmark"]
+        skip = None
+    return result
 
 DESIGN_DOC = {
     "views": {
@@ -51,29 +172,125 @@ def get_logger(app=None):
             _logger.setLevel(logging.DEBUG)
         else:
             _logger.setLevel(logging.WARNING)
-        if config["LOG_FILEPATH"]:
-            if config["LOG_ROTATING"]:
-                loghandler = logging.TimedRotatingFileHandler(
-                    config["LOG_FILEPATH"],
-                    when="midnight",
-                    backupCount=config["LOG_ROTATING"])
-            else:
-                loghandler = logging.FileHandler(config["LOG_FILEPATH"])
+        if config["LOG_JSON"]:
+            formatter = JsonFormatter()
         else:
-            loghandler = logging.StreamHandler()
-        loghandler.setFormatter(logging.Formatter(config["LOG_FORMAT"]))
-        _logger.addHandler(loghandler)
+            formatter = logging.Formatter(config["LOG_FORMAT"])
+        _logger.addHandler(get_log_handler(config, config["LOG_FILEPATH"],
+                                           formatter))
     return _logger
 
+def get_log_handler(config, filepath, formatter):
+    """Return a log handler for the file, or for stderr if no file.
+    The file is rotated by time or by size, if so configured.
+    Unless disabled, the records are formatted in the calling thread,
+    and written by a separate thread, via a queue.
+    """
+    if filepath:
+        if not config["LOG_ROTATING"]:
+            handler = logging.FileHandler(filepath)
+        elif config["LOG_ROTATE_BYTES"]:
+            handler = logging.handlers.RotatingFileHandler(
+                filepath,
+                maxBytes=config["LOG_ROTATE_BYTES"],
+                backupCount=config["LOG_ROTATING"])
+        else:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                filepath,
+                when=config["LOG_ROTATE_WHEN"],
+                backupCount=config["LOG_ROTATING"])
+    else:
+        handler = logging.StreamHandler()
+    if not config["LOG_QUEUE_SIZE"]:
+        handler.setFormatter(formatter)
+        return handler
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    result = LogQueueHandler(handler, config["LOG_QUEUE_SIZE"])
+    result.setFormatter(formatter)
+    return result
+
+
+class JsonFormatter(logging.Formatter):
+    """Format the log record as one line of JSON. The items of the
+    dictionary 'data', if given as extra for the record, are included.
+    """
+
+    def format(self, record):
+        result = {"time": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                        time.gmtime(record.created)) +
+                          f".{int(record.msecs):03d}Z",
+                  "level": record.levelname,
+                  "logger": record.name,
+                  "message": record.getMessage()}
+        data = getattr(record, "data", None)
+        if data:
+            result.update(data)
+        if record.exc_info:
+            result["exception"] = self.formatException(record.exc_info)
+        return jsonprovider.dumps_bytes(result, default=str).decode("utf-8")
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Put the formatted records on a queue, from which a separate thread
+    writes them using the target handler. If the queue is full, the
+    record is dropped instead of blocking the request; it is counted.
+    """
+
+    def __init__(self, target, size):
+        self.target = target
+        self.size = size
+        self.dropped = 0
+        super().__init__(None)
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        "Start the thread. Required also in a forked child process."
+        self.pid = os.getpid()
+        self.queue = queue.Queue(self.size)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def enqueue(self, record):
+        "Called with the handler lock held."
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        "Write the queued records, and stop the thread, if not done."
+        if self.pid != os.getpid() or self.listener is None: return
+        self.listener.stop()
+        self.listener = None
+
 def log_access(response):
-    "Record access using the logger."
-    if flask.g.current_user:
+    """Record access using the logger, with the timing of the request.
+    Only a sample of the requests is logged, if so configured; server
+    errors are always logged.
+    """
+    timings = timing.finish(response)
+    if response.status_code < 500 and \
+       random.random() >= flask.current_app.config["LOG_ACCESS_SAMPLE"]:
+        return response
+    if flask.g.get("current_user"):
         username = flask.g.current_user["username"]
     else:
         username = None
+    data = dict(remote_addr=flask.request.remote_addr,
+                username=username,
+                method=flask.request.method,
+                path=flask.request.path,
+                status=response.status_code)
+    if timings:
+        data.update(timings)
     get_logger().debug(f"{flask.request.remote_addr} {username}"
                        f" {flask.request.method} {flask.request.path}"
-                       f" {response.status_code}")
+                       f" {response.status_code}"
+                       f" {timing.get_summary(timings)}",
+                       extra={"data": data})
     return response
 
 # Global instance of mail interface.
@@ -116,6 +333,51 @@ class IuidConverter(werkzeug.routing.BaseConverter):
             raise werkzeug.routing.ValidationError
         return value.lower()    # Always lower case
 
+class Cache:
+    "Thread-safe in-process cache with time-to-live and LRU size bound."
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        "Return the cached value, or None if missing or expired."
+        with self.lock:
+            try:
+                value, expires = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.monotonic():
+                del self.items[key]
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        "Store the value, evicting the least recently used if full."
+        if self.size <= 0: return
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        "Remove the value, if cached."
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
 class Timer:
     "CPU timer."
     def __init__(self):
@@ -179,6 +441,8 @@ def csrf_token():
     # Generate a token to last the session's lifetime.
     if "_csrf_token" not in flask.session:
         flask.session["_csrf_token"] = get_iuid()
+    # The response must not be compressed; see 'compress.compress_response'.
+    flask.g.csrf_token_output = True
     html = '<input type="hidden" name="_csrf_token" value="%s">' % \
            flask.session["_csrf_token"]
     return jinja2.utils.Markup(html)
@@ -220,7 +484,7 @@ def tojson2(value, indent=2):
     """Transform to string JSON representation keeping single-quotes
     and indenting by 2 by default.
     """
-    return json.dumps(value, indent=indent)
+    return flask.current_app.json.dumps(value, indent=indent)
 
 def accept_json():
     "Return True if the header Accept contains the JSON content type."
@@ -250,21 +514,242 @@ def jsonify(result, schema_url=None):
         response.headers.add("Link", schema_url, rel="schema")
     return response
 
+def get_etag(*parts):
+    "Return a strong entity tag computed from the given parts."
+    data = "\0".join([str(p) for p in parts]).encode()
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def not_modified(etag):
+    """Return a 304 Not Modified response if the request header
+    If-None-Match matches the entity tag, else None.
+    """
+    if not flask.request.if_none_match.contains_weak(etag):
+        return None
+    return set_etag(flask.Response(status=http.client.NOT_MODIFIED), etag)
+
+def set_etag(response, etag):
+    """Set the entity tag of the response. Require revalidation, and
+    prevent shared caches from storing the response.
+    """
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def ndjson_response(items):
+    """Return a streamed Response containing the items in the iterable
+    as newline-delimited JSON; one object per line.
+    The request's database interface has been returned to the pool when
+    the response is streamed, so the generator acquires one of its own.
+    """
+    def generate():
+        flask.g.db = get_dbpool().acquire()
+        flask.g.dbserver = flask.g.db.server
+        exception = None
+        try:
+            for item in items:
+                yield flask.json.dumps(item) + "\n"
+        except Exception as error:
+            exception = error
+            raise
+        finally:
+            release_db(exception)
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype=constants.NDJSON_MIMETYPE)
+
 def get_dbserver(app=None):
-    "Get the connection to the CouchDB database server."
+    "Get a new connection to the CouchDB database server."
     if app is None:
         app = flask.current_app
-    return couchdb2.Server(href=app.config["COUCHDB_URL"],
-                           username=app.config["COUCHDB_USERNAME"],
-                           password=app.config["COUCHDB_PASSWORD"])
+    server = couchdb2.Server(href=app.config["COUCHDB_URL"],
+                             username=app.config["COUCHDB_USERNAME"],
+                             password=app.config["COUCHDB_PASSWORD"])
+    jsonprovider.use_couch_session(server)
+    return server
 
 def get_db(dbserver=None, app=None):
+    "Get the database interface, using a new server connection if none given."
     if app is None:
         app = flask.current_app
     if dbserver is None:
         dbserver = get_dbserver(app=app)
     return dbserver[app.config["COUCHDB_DBNAME"]]
 
+
+class ProcessLocal:
+    """Base for an object having threads, locks or connections, which
+    a forked child process must not share with its parent. The subclass
+    extends 'reset' to set them up; it is called on creation, and when
+    the object is got via 'get_instance' in another process.
+    """
+
+    def reset(self):
+        "Set up the state for the current process."
+        self.pid = os.getpid()
+
+    def in_process(self):
+        "Was the state set up by the current process?"
+        return self.pid == os.getpid()
+
+# Per-process instances of ProcessLocal subclasses, by class.
+_instances = {}
+_instances_lock = threading.Lock()
+
+def get_instance(cls, app=None, create=True):
+    """Get the instance of the class for this worker process, creating it
+    if needed, and resetting it if this is a forked child process.
+    Return None if it does not exist and 'create' is false.
+    """
+    instance = _instances.get(cls)
+    if instance is None:
+        if not create: return None
+        if app is None:
+            app = flask.current_app._get_current_object()
+        with _instances_lock:
+            instance = _instances.get(cls)
+            if instance is None:
+                instance = _instances[cls] = cls(app)
+    if not instance.in_process():
+        instance.reset()
+    return instance
+
+
+class DbPool(ProcessLocal):
+    """Pool of CouchDB database interfaces, each with its own server
+    connection and keep-alive HTTP session. One pool per worker process.
+    Thread-safe; a forked child process discards the parent's connections.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.size = app.config["COUCHDB_POOL_SIZE"]
+        self.timeout = app.config["COUCHDB_POOL_TIMEOUT"]
+        self.max_age = app.config["COUCHDB_POOL_MAX_AGE"]
+        self.reset()
+
+    def reset(self):
+        "Discard all connections."
+        super().reset()
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+        self.count = 0
+
+    def acquire(self):
+        """Get a database interface from the pool.
+        Create a new connection if none is idle and the pool is not full,
+        otherwise wait for one to be released.
+        """
+        while True:
+            try:
+                db = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    create = self.count < self.size
+                    if create:
+                        self.count += 1
+                if create:
+                    return self.create()
+                try:
+                    db = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise IOError("no CouchDB connection available in pool")
+            # Renew old connections; the CouchDB session cookie expires.
+            if time.monotonic() - db._pool_created < self.max_age:
+                return db
+            self.discard(db)
+
+    def create(self):
+        "Create a new connection; it has already been counted."
+        try:
+            db = get_db(app=self.app)
+        except Exception:
+            with self.lock:
+                self.count -= 1
+            raise
+        db._pool_pid = self.pid
+        db._pool_created = time.monotonic()
+        return db
+
+    def release(self, db):
+        "Return the database interface to the pool."
+        if getattr(db, "_pool_pid", None) != self.pid:
+            return              # Created before a fork; just drop it.
+        self.idle.put(db)
+
+    def discard(self, db):
+        "Close the connection and remove it from the pool."
+        if getattr(db, "_pool_pid", None) != self.pid:
+            return
+        with self.lock:
+            self.count -= 1
+        db.server._session.close()
+
+def get_dbpool(app=None):
+    "Get the database pool for this worker process, creating it if needed."
+    return get_instance(DbPool, app)
+
+def release_db(exception=None):
+    "Return the request's database interface to the pool."
+    db = flask.g.pop("db", None)
+    flask.g.pop("dbserver", None)
+    if db is None: return
+    if isinstance(exception, (IOError, couchdb2.ServerError)):
+        get_dbpool().discard(db)
+    else:
+        get_dbpool().release(db)
+
+def get_rev(docid):
+    """Return the current revision of the document in the current database,
+    or None if it does not exist. Only the headers are transferred.
+    """
+    response = flask.g.db.server._HEAD(flask.g.db.name, docid,
+                                       errors={404: None})
+    if response.status_code != 200: return None
+    return response.headers["ETag"].strip('"')
+
+def view(designname, viewname, read=None, **kwargs):
+    """Query the view in the current database. If the named read is
+    configured for stale reads, the view index is not updated before
+    returning the result ('update' is "false" or "lazy"), and only
+    stable shards are used. Otherwise the index is brought up to date.
+    """
+    update = get_stale_read(read)
+    if update is None:
+        return flask.g.db.view(designname, viewname, **kwargs)
+    params = {"update": update, "stable": "true"}
+    for key in ["key", "keys", "startkey", "endkey"]:
+        if kwargs.get(key) is not None:
+            params[key] = json.dumps(kwargs[key])
+    for key in ["skip", "limit"]:
+        if kwargs.get(key) is not None:
+            params[key] = str(kwargs[key])
+    for key in ["descending", "include_docs"]:
+        if kwargs.get(key):
+            params[key] = "true"
+    unknown = set(kwargs).difference(["key", "keys", "startkey", "endkey",
+                                      "skip", "limit",
+                                      "descending", "include_docs"])
+    if unknown:
+        raise ValueError(f"unsupported view arguments: {unknown}")
+    response = flask.g.db.server._GET(flask.g.db.name, "_design", designname,
+                                      "_view", viewname, params=params)
+    data = response.json()
+    return couchdb2.ViewResult([couchdb2.Row(r.get("id"), r.get("key"),
+                                             r.get("value"), r.get("doc"))
+                                for r in data.get("rows", [])],
+                               data.get("offset"),
+                               data.get("total_rows"))
+
+def get_stale_read(read):
+    """Return the 'update' value for the named read if it is configured
+    for stale reads, else None.
+    """
+    if read is None: return None
+    update = flask.current_app.config["COUCHDB_STALE_READS"].get(read)
+    if update is None: return None
+    assert update in ("false", "lazy")
+    return update
+
 def get_logs(docid, cleanup=True):
     """Return the list of log entries for the given document identifier,
     sorted by reverse timestamp.
@@ -276,10 +761,111 @@ def get_logs(docid, cleanup=True):
                                              include_docs=True)]
     if cleanup:
         for log in result:
-            for key in ["_id", "_rev", "doctype", "docid"]:
-                log.pop(key)
+            cleanup_log(log)
     return result
 
+def get_logs_page(docid, limit, cursor=None, cleanup=True):
+    """Return a page of at most 'limit' log entries for the given document
+    identifier, sorted by reverse timestamp, and the cursor for the next page,
+    which is None if this is the last page. Start at the given cursor.
+    Raise ValueError if the cursor is invalid.
+    """
+    if cursor:
+        cursor = decode_cursor(cursor)
+        if not isinstance(cursor[0], list) or cursor[0][:1] != [docid]:
+            raise ValueError("invalid cursor")
+    rows, cursor = get_view_page("logs", "doc", limit, cursor=cursor,
+                                 read="logs",
+                                 startkey=[docid, "ZZZZZZ"],
+                                 endkey=[docid],
+                                 descending=True,
+                                 include_docs=True)
+    result = [r.doc for r in rows]
+    if cleanup:
+        for log in result:
+            cleanup_log(log)
+    return result, cursor and encode_cursor(cursor)
+
+def get_latest_log_key(docid):
+    """Return the identifier and key of the latest log entry for the given
+    document identifier, or None if there is none.
+    """
+    rows = view("logs", "doc", read="logs",
+                startkey=[docid, "ZZZZZZ"], endkey=[docid],
+                descending=True, limit=1)
+    if len(rows) == 0: return None
+    return (rows[0].id, rows[0].key)
+
+def cleanup_log(log):
+    "Remove the internal items from the log entry."
+    for key in ["_id", "_rev", "doctype", "docid"]:
+        log.pop(key)
+
+def get_view_page(designname, viewname, limit, cursor=None, **kwargs):
+    """Return a page of at most 'limit' rows from the view, and the cursor
+    for the next page, which is None if this is the last page.
+    The cursor is a tuple (key, skip): the key of the first row of the
+    next page, and the number of rows with that same key in previous pages.
+    The skip is normally zero, so the view query is efficient.
+    Other keyword arguments are passed to the view query; see 'view'.
+    """
+    if cursor:
+        kwargs["startkey"], skip = cursor
+    else:
+        skip = 0
+    rows = view(designname, viewname,
+                skip=skip or None, limit=limit+1, **kwargs)
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    key = rows[limit].key
+    same = 0
+    for row in reversed(rows[:limit]):
+        if row.key != key: break
+        same += 1
+    if cursor and cursor[0] == key:
+        same += skip
+    return rows[:limit], (key, same)
+
+def iter_view(designname, viewname, page_size, **kwargs):
+    """Return a generator of all rows in the view, fetched in pages
+    of the given size. Other keyword arguments are passed to the view query.
+    """
+    cursor = None
+    while True:
+        rows, cursor = get_view_page(designname, viewname, page_size,
+                                     cursor=cursor, **kwargs)
+        yield from rows
+        if not cursor: break
+
+def encode_cursor(cursor):
+    "Encode the view page cursor as an opaque URL-safe string."
+    data = json.dumps(cursor, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    "Decode the view page cursor. Raise ValueError if invalid."
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key, skip = json.loads(data)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+    if not isinstance(skip, int) or skip < 0:
+        raise ValueError("invalid cursor")
+    return (key, skip)
+
+def get_page_limit():
+    """Return the page limit given in the request, or the default.
+    Raise ValueError if invalid.
+    """
+    limit = flask.request.args.get("limit")
+    if limit is None:
+        return flask.current_app.config["LOGS_PAGE_LIMIT"]
+    limit = int(limit)
+    if limit <= 0 or limit > flask.current_app.config["PAGE_MAX_LIMIT"]:
+        raise ValueError("invalid limit")
+    return limit
+
 
 class JsonException(Exception):
     "JSON API error response."